@@ -0,0 +1,7 @@
+create table uploaded_data.block_group_crosswalk
+(
+	block_geo_id varchar(20),
+	geo_level varchar(30),
+	geo_id varchar(20),
+	area_weight double precision
+);
@@ -1,135 +1,273 @@
 import os
+import sys
+import argparse
+from functools import partial
+from typing import Iterator
+import tracemalloc
+import pandas as pd
 from sqlalchemy import text
 from data_integration.census_data.field_lookup import create_census_variable_output
-from data_integration.unmet_needs.unmet_needs import get_supply_demand_with_cae
-from data_integration.ece_data.pull_ece_data import backfill_ece, get_space_df
+from data_integration.unmet_needs.unmet_needs import get_supply_demand_with_cae, OVERALL_DATA_FILE
+from data_integration.ece_data.pull_ece_data import incremental_backfill_ece_chunks, get_space_df, LOOKBACK_MONTHS
 from data_integration.july_2020.build_tables import build_site_df, build_student_df
 from data_integration.july_2020.merge_leg import merge_legislative_data
 from data_integration.census_data.setup_geo_json import load_level_table
 from data_integration.census_data.shapefiles import TOWN, HOUSE, SENATE, BLOCK, TIGER, \
     FINAL_NAME,FINAL_GEO_ID, FINAL_TOWN_ID, FINAL_COUNTY_ID, FINAL_STATE_ID, FINAL_HOUSE_ID,\
     FINAL_SENATE_ID, FINAL_TRACT_ID, FINAL_BLOCK_ID
-from data_integration.connections.databases import get_db_connection
-from data_integration.census_data.bulk_geocoding import run_geo_code
+from data_integration.connections.databases import get_engine, db_connection
+from data_integration.connections.bulk_load import copy_dataframe
+from data_integration.connections.table_indexes import index_table, print_index_report
+from data_integration.census_data.block_crosswalk import get_crosswalk, CROSSWALK_TABLE
+from data_integration.census_data.bulk_geocoding import run_geo_code, GEOCODE_WORKERS, GEOCODE_BACKENDS, \
+    CENSUS_BACKEND
 from demand_estimation.estimate_eligible_population import get_town_eligible_df
 from demand_estimation.calculate_town_demand import create_final_town_demand
 from demand_estimation.demand_estimate_script import build_need_demand_df
 from data_integration.historical_care_4_kids.data_aggregation import get_historical_c4k
 from record_deduplication.dedupe import get_dedupe_mapping_from_db
+from build_pipeline.cache import StageCache
+from build_pipeline.metrics import METRICS_FOLDER
+from build_pipeline.writers import output_file, CSV, VALID_FORMATS
+from build_pipeline.scheduler import Stage, run_stages, select_stages, IO_STAGE, CPU_STAGE, \
+    DEFAULT_IO_WORKERS, DEFAULT_CPU_WORKERS
 
 DB_DATA_FOLDER = 'final_data'
 CUR_FOLDER = os.path.dirname(os.path.realpath(__file__))
 NEED_SINGLE_VARIABLE = f'{CUR_FOLDER}/demand_estimation/need_single_field_lookups.txt'
 NEED_MULTI_VARIABLE = f'{CUR_FOLDER}/demand_estimation/need_combination_field_lookups.txt'
 TABLE_FOLDER = f'{CUR_FOLDER}/analytics_tables/'
+SUPERSET_DB_SECTION = 'SUPERSET DB'
+ECE_DB_SECTION = 'ECE Reporter DB'
+ECE_PARTITION_FOLDER = 'pii/ece_months'
+GEOCODE_CACHE_FILE = 'pii/geocode_cache.sqlite'
+GEOCODE_CHECKPOINT_FOLDER = 'pii/geocode_checkpoints'
 
+# Join keys indexed on the tables created from analytics_tables, geography tables are indexed as they're loaded
+TABLE_KEY_COLUMNS = {'ece_student_data_geocode': ['child_id', 'block_geoid', 'county_subdivision_geoid',
+                                                  'sldu_geoid', 'sldl_geoid'],
+                     'ece_student_data': ['source_child_id', 'reporting_period'],
+                     CROSSWALK_TABLE: ['block_geo_id', 'geo_id']}
 
-def get_demand_estimates(filename):
+# Source folders used to fingerprint stage inputs
+INTEGRATION_FOLDER = f'{CUR_FOLDER}/data_integration'
+UNMET_NEEDS_FOLDER = f'{INTEGRATION_FOLDER}/unmet_needs'
+JULY_2020_FOLDER = f'{INTEGRATION_FOLDER}/july_2020'
+ECE_FOLDER = f'{INTEGRATION_FOLDER}/ece_data'
+CENSUS_FOLDER = f'{INTEGRATION_FOLDER}/census_data'
+C4K_FOLDER = f'{INTEGRATION_FOLDER}/historical_care_4_kids'
+DEMAND_FOLDER = f'{CUR_FOLDER}/demand_estimation'
+DEDUPE_FOLDER = f'{CUR_FOLDER}/record_deduplication'
+
+
+def get_unmet_needs() -> pd.DataFrame:
+    df, _ = get_supply_demand_with_cae()
+    return df
+
+
+def get_demand_estimates() -> pd.DataFrame:
 
     eligible_df = get_town_eligible_df()
     town_df = create_census_variable_output(single_field_mapping_file=NEED_SINGLE_VARIABLE, combination_field_mapping_file=NEED_MULTI_VARIABLE)
     demand_df = build_need_demand_df(town=town_df, filename=None)
-    create_final_town_demand(parent_metric_df=demand_df, smi_df=eligible_df, write_filename=filename)
+    return create_final_town_demand(parent_metric_df=demand_df, smi_df=eligible_df)
 
 
-def get_deduplication(filename):
-    ece_conn = get_db_connection(section='ECE Reporter DB')
-    dedupe_df = get_dedupe_mapping_from_db(db_conn=ece_conn)
-    dedupe_df.to_csv(filename, index=False)
+def get_deduplication() -> pd.DataFrame:
+    with db_connection(section=ECE_DB_SECTION, stream_results=True) as ece_conn:
+        return get_dedupe_mapping_from_db(db_conn=ece_conn)
 
 
-def get_ece_student_data(filename):
-    ece_conn = get_db_connection(section='ECE Reporter DB')
-    child_df = backfill_ece(ece_conn)
-    child_df.to_csv(filename, index=False)
+def get_ece_student_data(partition_folder: str, lookback_months: int = LOOKBACK_MONTHS,
+                         full_refresh: bool = False) -> Iterator[pd.DataFrame]:
+    # A generator so the connection stays open while the stage writes each chunk
+    with db_connection(section=ECE_DB_SECTION, stream_results=True) as ece_conn:
+        yield from incremental_backfill_ece_chunks(ece_conn, partition_folder=partition_folder,
+                                                   lookback_months=lookback_months, full_refresh=full_refresh)
 
-def get_ece_geocode(filename):
-    ece_conn = get_db_connection(section='ECE Reporter DB')
-    geocode_df = run_geo_code(ece_conn)
-    geocode_df.to_csv(filename, index=False)
 
-def get_ece_site_data(filename):
-    ece_conn = get_db_connection(section='ECE Reporter DB')
-    site_df = get_space_df(ece_conn)
-    site_df.to_csv(filename, index=False)
+def get_ece_geocode(workers: int = GEOCODE_WORKERS, cache_file: str = None, backend: str = CENSUS_BACKEND,
+                    checkpoint_folder: str = None) -> pd.DataFrame:
+    with db_connection(section=ECE_DB_SECTION, stream_results=True) as ece_conn:
+        return run_geo_code(ece_conn, workers=workers, cache_file=cache_file, backend=backend,
+                            checkpoint_folder=checkpoint_folder)
 
 
-def get_july_2020_sites(filename):
+def get_ece_site_data() -> pd.DataFrame:
+    with db_connection(section=ECE_DB_SECTION) as ece_conn:
+        return get_space_df(ece_conn)
+
+
+def get_july_2020_sites() -> pd.DataFrame:
 
     site_df = build_site_df()
-    merge_legislative_data(site_df, filename)
+    return merge_legislative_data(site_df)
 
 
-def get_july_2020_students(filename):
+def get_july_2020_students() -> pd.DataFrame:
     student_df = build_student_df()
-    merge_legislative_data(student_df, filename)
+    return merge_legislative_data(student_df)
 
 
-def load_shapefiles_to_db():
+def load_shapefiles_to_db(db_engine=None, cluster: bool = False):
     """
     Loads town, house, block and senate shapefiles to the dashboard database
+    :param db_engine: engine for the dashboard database, defaults to the pooled SUPERSET DB engine
+    :param cluster: whether to cluster each table on its spatial index
     :return: None, adds data to DB
     """
-    db_engine = get_db_connection(section='SUPERSET DB')
+    db_engine = db_engine or get_engine(section=SUPERSET_DB_SECTION)
     town_cols = [FINAL_NAME, FINAL_STATE_ID, FINAL_COUNTY_ID, FINAL_TOWN_ID, FINAL_GEO_ID, 'lat', 'long']
-    load_level_table(geo_level=TOWN, table_name='ct_town_geo', columns=town_cols, engine=db_engine)
+    load_level_table(geo_level=TOWN, table_name='ct_town_geo', columns=town_cols, engine=db_engine,
+                     cluster=cluster)
 
     house_cols = [FINAL_STATE_ID, FINAL_HOUSE_ID, FINAL_GEO_ID, 'legislator_name', 'legislator_party','lat', 'long']
-    load_level_table(geo_level=HOUSE, table_name='ct_house_geo', columns=house_cols, engine=db_engine)
+    load_level_table(geo_level=HOUSE, table_name='ct_house_geo', columns=house_cols, engine=db_engine,
+                     cluster=cluster)
 
     senate_cols = [FINAL_STATE_ID, FINAL_SENATE_ID, FINAL_GEO_ID, 'legislator_name', 'legislator_party', 'lat', 'long']
-    load_level_table(geo_level=SENATE, table_name='ct_senate_geo', columns=senate_cols, engine=db_engine)
+    load_level_table(geo_level=SENATE, table_name='ct_senate_geo', columns=senate_cols, engine=db_engine,
+                     cluster=cluster)
 
     block_cols = [FINAL_STATE_ID, FINAL_COUNTY_ID, FINAL_TRACT_ID, FINAL_BLOCK_ID, FINAL_GEO_ID, 'lat', 'long']
-    load_level_table(geo_level=BLOCK, table_name='ct_census_blocks', columns=block_cols, file_type=TIGER, engine=db_engine)
+    load_level_table(geo_level=BLOCK, table_name='ct_census_blocks', columns=block_cols, file_type=TIGER, engine=db_engine,
+                     cluster=cluster)
 
 
-def init_database(init_postgis: bool=False):
+def init_database(init_postgis: bool=False, cluster: bool = False):
     """
     Adds initial tables to database and loads postgis
     :param init_postgis: Boolean whether to install postgis in database
+    :param cluster: whether to cluster the geography tables on their spatial indexes
     :return:
     """
-    db_engine = get_db_connection(section='SUPERSET DB')
+    db_engine = get_engine(section=SUPERSET_DB_SECTION)
     if init_postgis:
         db_engine.execute('CREATE EXTENSION postgis')
-    load_shapefiles_to_db(db_engine)
+    load_shapefiles_to_db(db_engine, cluster=cluster)
 
     # Load all tables in analytics table folder
     for filename in os.listdir(TABLE_FOLDER):
         print(f"Creating {filename}")
         db_engine.execute(text(open(TABLE_FOLDER + filename).read()))
 
+    # Block group to town and district weights, for rolling block group data up without spatial joins
+    with db_engine.connect() as conn:
+        copy_dataframe(get_crosswalk(), table_name=CROSSWALK_TABLE, conn=conn)
+        for table_name, key_columns in TABLE_KEY_COLUMNS.items():
+            index_table(conn, table_name, key_columns=key_columns)
+        print_index_report(conn)
 
-if __name__ == '__main__':
 
-    # Write CAE CSV
-    print("Pulling Unmet needs report")
-    get_supply_demand_with_cae(filename=f'{DB_DATA_FOLDER}/overall_supply_demand_with_cae.csv')
-
-    # Write July data CSV
-    print("Pulling July 2020 data")
-    get_july_2020_sites(filename=f"{DB_DATA_FOLDER}/july_2020_sites.csv")
-    get_july_2020_students(filename=f"{DB_DATA_FOLDER}/pii/july_2020.csv")
-
-    # Get ECE Data
-    print("Pulling ECE student data")
-    get_ece_student_data(filename=f"{DB_DATA_FOLDER}/pii/ece_student_data.csv")
-    print("Pulling ECE site data")
-    get_ece_site_data(filename=f"{DB_DATA_FOLDER}/ece_space_data.csv")
-    print("Geocoding ECE data")
-    get_ece_geocode(filename=f"{DB_DATA_FOLDER}/pii/ece_student_data_geocode.csv")
-    print("Deduplicating data")
-    get_deduplication(filename=f'{DB_DATA_FOLDER}/pii/ece_deduplication.csv')
-
-    ## TODO
-    # Add ECE table creation for students/geos into script as well as loading CSV directly to DB
+def build_stages(data_folder: str = DB_DATA_FOLDER, output_format: str = CSV, ece_lookback_months: int = LOOKBACK_MONTHS,
+                 ece_full_refresh: bool = False, geocode_workers: int = GEOCODE_WORKERS,
+                 geocoder: str = CENSUS_BACKEND) -> [Stage]:
+    """
+    Declares every step of the build with the executor it should run on and the steps it needs first
+    :param data_folder: folder the output files are written to
+    :param output_format: file format of the outputs, CSV is needed for the Superset upload
+    :param ece_lookback_months: months before the last ECE pull to query again
+    :param ece_full_refresh: pull every ECE month instead of only the newest ones
+    :param geocode_workers: batches sent to the Census geocoder at the same time
+    :param geocoder: geocoder backend, the local one works offline from TIGER address ranges
+    :return: list of stages
+    """
+    def output(name):
+        return output_file(data_folder, name, output_format)
+
+    stages = [
+        Stage(name='unmet_needs', function=get_unmet_needs, stage_type=CPU_STAGE,
+              output=output('overall_supply_demand_with_cae'), table='overall_supply_demand_with_cae',
+              description='Pulling Unmet needs report', keep_index=True,
+              inputs=[f'{UNMET_NEEDS_FOLDER}/unmet_needs.py', OVERALL_DATA_FILE]),
+        Stage(name='july_2020_sites', function=get_july_2020_sites, stage_type=IO_STAGE,
+              output=output('july_2020_sites'), table='july_2020_sites',
+              description='Pulling July 2020 site data', inputs=[JULY_2020_FOLDER]),
+        Stage(name='july_2020_students', function=get_july_2020_students, stage_type=CPU_STAGE,
+              output=output('pii/july_2020'), table='july_2020',
+              description='Pulling July 2020 student data', inputs=[JULY_2020_FOLDER]),
+        Stage(name='ece_students', stage_type=IO_STAGE,
+              function=partial(get_ece_student_data, partition_folder=f'{data_folder}/{ECE_PARTITION_FOLDER}',
+                               lookback_months=ece_lookback_months, full_refresh=ece_full_refresh),
+              output=output('pii/ece_student_data'), table='ece_student_data',
+              description='Pulling ECE student data', inputs=[ECE_FOLDER], remote=True),
+        Stage(name='ece_sites', function=get_ece_site_data, stage_type=IO_STAGE,
+              output=output('ece_space_data'), table='ece_space_data',
+              description='Pulling ECE site data', inputs=[ECE_FOLDER], remote=True),
+        Stage(name='ece_geocode', stage_type=IO_STAGE,
+              # Only Census results are cached, local geocoding is cheap to repeat
+              function=partial(get_ece_geocode, workers=geocode_workers, backend=geocoder,
+                               cache_file=f'{data_folder}/{GEOCODE_CACHE_FILE}' if geocoder == CENSUS_BACKEND else None,
+                               checkpoint_folder=f'{data_folder}/{GEOCODE_CHECKPOINT_FOLDER}/{geocoder}'),
+              output=output('pii/ece_student_data_geocode'), table='ece_student_data_geocode',
+              description='Geocoding ECE data', remote=True,
+              inputs=[f'{CENSUS_FOLDER}/bulk_geocoding.py', f'{CENSUS_FOLDER}/geocode_cache.py',
+                      f'{CENSUS_FOLDER}/shapefiles.py', f'{CENSUS_FOLDER}/geo_assigner.py',
+                      f'{CENSUS_FOLDER}/block_crosswalk.py', f'{CENSUS_FOLDER}/local_geocoder.py',
+                      f'{CENSUS_FOLDER}/geocode_checkpoint.py']),
+        Stage(name='ece_deduplication', function=get_deduplication, stage_type=CPU_STAGE,
+              output=output('pii/ece_deduplication'), table='ece_deduplication',
+              description='Deduplicating data', inputs=[f'{DEDUPE_FOLDER}/dedupe.py'], remote=True),
+        Stage(name='demand_estimation', function=get_demand_estimates, stage_type=IO_STAGE,
+              output=output('demand_estimation'), table='demand_estimation',
+              description='Getting demand estimation',
+              inputs=[f'{DEMAND_FOLDER}/estimate_eligible_population.py', f'{DEMAND_FOLDER}/calculate_town_demand.py',
+                      f'{DEMAND_FOLDER}/demand_estimate_script.py', f'{DEMAND_FOLDER}/town_data.csv',
+                      NEED_SINGLE_VARIABLE, NEED_MULTI_VARIABLE, f'{CENSUS_FOLDER}/field_lookup.py',
+                      f'{CENSUS_FOLDER}/census_cache.py']),
+        Stage(name='historical_c4k', function=get_historical_c4k, stage_type=CPU_STAGE,
+              output=output('all_c4k_data'), table='all_c4k_data',
+              description='Getting historical C4K data', inputs=[C4K_FOLDER]),
+    ]
+    for stage in stages:
+        stage.output_format = output_format
+    return stages
 
-    # Build demand estimates
-    print("Getting demand estimation")
-    get_demand_estimates(filename=f"{DB_DATA_FOLDER}/demand_estimation.csv")
 
-    # Get C4K data
-    print("Getting historical C4K data")
-    get_historical_c4k(final_filename=f"{DB_DATA_FOLDER}/all_c4k_data.csv")
+if __name__ == '__main__':
 
+    parser = argparse.ArgumentParser(description='Build the data files in final_data')
+    parser.add_argument('--stages', nargs='+', help='Only run these stages and the stages they depend on')
+    parser.add_argument('--io-workers', type=int, default=DEFAULT_IO_WORKERS, help='Threads for I/O bound stages')
+    parser.add_argument('--cpu-workers', type=int, default=DEFAULT_CPU_WORKERS, help='Processes for CPU bound stages')
+    parser.add_argument('--rebuild', action='store_true', help='Run stages even if their inputs are unchanged')
+    parser.add_argument('--metrics-folder', default=f'{DB_DATA_FOLDER}/{METRICS_FOLDER}',
+                        help='Folder for the per stage metrics report and profiles')
+    parser.add_argument('--profile', nargs='+', default=[], help='Run these stages under cProfile')
+    parser.add_argument('--ece-lookback-months', type=int, default=LOOKBACK_MONTHS,
+                        help='Months before the last ECE pull to query again, older months are read from disk')
+    parser.add_argument('--ece-full-refresh', action='store_true', help='Pull every ECE month from the database')
+    parser.add_argument('--geocode-workers', type=int, default=GEOCODE_WORKERS,
+                        help='Batches sent to the Census geocoder at the same time')
+    parser.add_argument('--geocoder', choices=GEOCODE_BACKENDS, default=CENSUS_BACKEND,
+                        help='Geocode with the Census API or offline from TIGER address ranges')
+    parser.add_argument('--format', choices=VALID_FORMATS, default=CSV,
+                        help='Output file format, parquet keeps column types and arrow can be memory mapped')
+    parser.add_argument('--load', action='store_true',
+                        help='COPY each output into the uploaded_data schema of the SUPERSET DB after it is written')
+    parser.add_argument('--index-report', action='store_true',
+                        help='Print the indexes of every table in the uploaded_data schema of the SUPERSET DB and exit')
+    parser.add_argument('--trace-memory', action='store_true',
+                        help='Record peak Python allocations with tracemalloc, this slows the build down')
+    args = parser.parse_args()
+
+    if args.index_report:
+        with db_connection(section=SUPERSET_DB_SECTION) as superset_conn:
+            print_index_report(superset_conn)
+        sys.exit()
+
+    os.makedirs(f'{DB_DATA_FOLDER}/pii', exist_ok=True)
+    if args.trace_memory:
+        # The environment variable turns tracing on in the worker processes as well
+        os.environ['PYTHONTRACEMALLOC'] = '1'
+        tracemalloc.start()
+    stages = build_stages(output_format=args.format, ece_lookback_months=args.ece_lookback_months,
+                          ece_full_refresh=args.ece_full_refresh, geocode_workers=args.geocode_workers,
+                          geocoder=args.geocoder)
+    if args.stages:
+        stages = select_stages(stages, args.stages)
+
+    run_stages(stages, io_workers=args.io_workers, cpu_workers=args.cpu_workers,
+               cache=StageCache(DB_DATA_FOLDER), force_rebuild=args.rebuild,
+               metrics_folder=args.metrics_folder, profile_stages=args.profile,
+               load_section=SUPERSET_DB_SECTION if args.load else None)
@@ -0,0 +1,128 @@
+import os
+import json
+import hashlib
+from datetime import date
+from typing import Dict, List
+
+CACHE_FILE_NAME = '.stage_cache.json'
+HASH_CHUNK_SIZE = 1024 * 1024
+
+# Fingerprint keys
+FINGERPRINT_KEY = 'fingerprint'
+OUTPUT_KEY = 'output'
+SIZE_KEY = 'size'
+MODIFIED_KEY = 'modified_ns'
+LOADED_KEY = 'loaded_fingerprint'
+
+
+def hash_file(file_name: str, hasher) -> None:
+    """
+    Adds the contents of a file to a running hash in fixed size chunks
+    :param file_name: path to file
+    :param hasher: hashlib object to update
+    :return: None, updates hasher
+    """
+    with open(file_name, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            hasher.update(chunk)
+
+
+def list_input_files(path: str) -> List[str]:
+    """
+    Expands a file or directory into a sorted list of the files it contains, skipping hidden files and caches
+    :param path: file or directory path
+    :return: list of file paths
+    """
+    if not os.path.isdir(path):
+        return [path]
+    file_list = []
+    for root, dirs, files in os.walk(path):
+        dirs[:] = [x for x in dirs if not x.startswith('.') and x != '__pycache__']
+        file_list.extend(os.path.join(root, x) for x in files if not x.startswith('.'))
+    return sorted(file_list)
+
+
+def fingerprint_stage(stage, upstream_fingerprints: List[str]) -> str:
+    """
+    Hashes everything a stage's output depends on: the stage definition, the contents of its input
+    files and directories and the fingerprints of the stages it depends on. Stages that read from
+    a database or remote API can't be hashed by content so they are keyed by day instead
+    :param stage: Stage to fingerprint
+    :param upstream_fingerprints: fingerprints of stages this stage depends on
+    :return: hex digest
+    """
+    hasher = hashlib.sha256()
+
+    # Parameters bound with functools.partial are part of the stage definition
+    function = getattr(stage.function, 'func', stage.function)
+    parameters = getattr(stage.function, 'keywords', {})
+    definition = {'name': stage.name,
+                  'function': f'{function.__module__}.{function.__qualname__}',
+                  'parameters': {key: str(value) for key, value in parameters.items()},
+                  'output': stage.output,
+                  'upstream': upstream_fingerprints}
+    if stage.remote:
+        definition['pulled_on'] = date.today().isoformat()
+    hasher.update(json.dumps(definition, sort_keys=True).encode())
+
+    for input_path in sorted(stage.inputs):
+        for file_name in list_input_files(input_path):
+            if not os.path.exists(file_name):
+                raise Exception(f"Input {file_name} for stage {stage.name} does not exist")
+            hasher.update(file_name.encode())
+            hash_file(file_name, hasher)
+    return hasher.hexdigest()
+
+
+class StageCache:
+    """
+    Records the input fingerprint of each stage's last successful run next to its output so
+    unchanged stages can be skipped
+    """
+
+    def __init__(self, data_folder: str):
+        self.cache_file = os.path.join(data_folder, CACHE_FILE_NAME)
+        self.entries: Dict[str, dict] = {}
+        if os.path.exists(self.cache_file):
+            with open(self.cache_file) as f:
+                self.entries = json.load(f)
+
+    def is_fresh(self, stage, fingerprint: str, require_loaded: bool = False) -> bool:
+        """
+        A stage is fresh if its fingerprint matches the last run and the output it wrote is still untouched
+        :param stage: Stage to check
+        :param fingerprint: current fingerprint of the stage inputs
+        :param require_loaded: also require that this output was loaded to the database
+        :return: True if the stage can be skipped
+        """
+        entry = self.entries.get(stage.name)
+        if not entry or entry[FINGERPRINT_KEY] != fingerprint or entry[OUTPUT_KEY] != stage.output:
+            return False
+        if require_loaded and entry.get(LOADED_KEY) != fingerprint:
+            return False
+        if not os.path.exists(stage.output):
+            return False
+        file_stat = os.stat(stage.output)
+        return file_stat.st_size == entry[SIZE_KEY] and file_stat.st_mtime_ns == entry[MODIFIED_KEY]
+
+    def record(self, stage, fingerprint: str, loaded: bool = False) -> None:
+        """
+        Stores the fingerprint of a successful run and saves the cache file
+        :param stage: Stage that finished
+        :param fingerprint: fingerprint of the inputs it ran with
+        :param loaded: whether the output was also loaded to the database
+        :return: None, writes the cache file
+        """
+        file_stat = os.stat(stage.output)
+        previous_load = self.entries.get(stage.name, {}).get(LOADED_KEY)
+        self.entries[stage.name] = {FINGERPRINT_KEY: fingerprint,
+                                    OUTPUT_KEY: stage.output,
+                                    SIZE_KEY: file_stat.st_size,
+                                    MODIFIED_KEY: file_stat.st_mtime_ns,
+                                    LOADED_KEY: fingerprint if loaded else previous_load}
+
+        # Write to a temporary file first so an interrupted run can't leave a half written cache
+        temp_file = self.cache_file + '.tmp'
+        with open(temp_file, 'w') as f:
+            json.dump(self.entries, f, indent=2, sort_keys=True)
+        os.replace(temp_file, self.cache_file)
@@ -0,0 +1,213 @@
+import os
+import csv
+import json
+import time
+import cProfile
+import pstats
+import resource
+import inspect
+import functools
+import threading
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime
+
+METRICS_FOLDER = 'metrics'
+METRICS_JSON_FILE = 'build_metrics.json'
+METRICS_CSV_FILE = 'build_metrics.csv'
+PROFILE_STATS_LINES = 25
+
+# Fields of a metrics record, in the order they are written to the CSV report
+NAME_KEY = 'name'
+STAGE_KEY = 'stage'
+STATUS_KEY = 'status'
+STARTED_KEY = 'started_at'
+WALL_KEY = 'wall_seconds'
+CPU_KEY = 'cpu_seconds'
+# Memory figures are high water marks of the process a record ran in, not of the record itself. Stages on the
+# thread pool share the build's process and process pool workers are reused, so they can include another stage's peak
+RSS_KEY = 'process_peak_rss_mb'
+TRACED_KEY = 'process_peak_traced_mb'
+ROWS_IN_KEY = 'rows_in'
+ROWS_OUT_KEY = 'rows_out'
+BYTES_KEY = 'bytes_written'
+CHILDREN_KEY = 'functions'
+REPORT_FIELDS = [STAGE_KEY, NAME_KEY, STATUS_KEY, STARTED_KEY, WALL_KEY, CPU_KEY, RSS_KEY, TRACED_KEY,
+                 ROWS_IN_KEY, ROWS_OUT_KEY, BYTES_KEY]
+
+SUCCESS = 'success'
+FAILED = 'failed'
+SKIPPED = 'skipped'
+
+# Each thread keeps the stack of records it's currently timing so nested hot functions attach to their stage
+_local = threading.local()
+
+
+def _record_stack() -> list:
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+    return _local.stack
+
+
+def _peak_rss_mb() -> float:
+    # ru_maxrss is the high water mark for the whole process in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def new_record(name: str, status: str = SUCCESS) -> dict:
+    return {NAME_KEY: name, STATUS_KEY: status, STARTED_KEY: datetime.now().isoformat(timespec='seconds'),
+            WALL_KEY: None, CPU_KEY: None, RSS_KEY: None, TRACED_KEY: None,
+            ROWS_IN_KEY: None, ROWS_OUT_KEY: None, BYTES_KEY: None, CHILDREN_KEY: []}
+
+
+@contextmanager
+def track(name: str):
+    """
+    Times the enclosed block and yields its metrics record. Records opened inside another record on
+    the same thread are attached to it as children. CPU time is for the current thread only. Peak RSS and peak
+    traced memory are the process's high water marks when the block finished, so they are an upper bound for the
+    block and can come from other stages running in the same process. Traced memory is only filled in when
+    tracemalloc is running, its peak isn't reset per record since that would reset it for concurrent stages too
+    :param name: name of the stage or function being measured
+    :return: metrics record dictionary
+    """
+    record = new_record(name)
+    stack = _record_stack()
+    if stack:
+        stack[-1][CHILDREN_KEY].append(record)
+    stack.append(record)
+
+    tracing = tracemalloc.is_tracing()
+    wall_start = time.perf_counter()
+    cpu_start = time.thread_time()
+    try:
+        yield record
+    except Exception:
+        record[STATUS_KEY] = FAILED
+        raise
+    finally:
+        record[WALL_KEY] = round(time.perf_counter() - wall_start, 3)
+        record[CPU_KEY] = round(time.thread_time() - cpu_start, 3)
+        record[RSS_KEY] = round(_peak_rss_mb(), 1)
+        if tracing:
+            record[TRACED_KEY] = round(tracemalloc.get_traced_memory()[1] / 1024 ** 2, 1)
+        # Generators can finish out of order so remove this record rather than the last one
+        stack.remove(record)
+
+
+def add_rows_in(rows: int) -> None:
+    """
+    Counts rows read from a source against every record currently open on this thread, so a stage
+    totals the rows read by the functions it calls. Call this where data enters the pipeline only
+    :param rows: number of rows read
+    :return: None
+    """
+    for record in _record_stack():
+        record[ROWS_IN_KEY] = (record[ROWS_IN_KEY] or 0) + rows
+
+
+def bind_record(function):
+    """
+    Wraps a function that's about to be submitted to a thread pool so the timed functions it calls attach to the
+    record open on the submitting thread. Worker threads start with an empty record stack, without this their
+    timings would be dropped
+    :param function: function to run on another thread
+    :return: wrapped function
+    """
+    stack = _record_stack()
+    parent = stack[-1] if stack else None
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        if parent is None:
+            return function(*args, **kwargs)
+        worker_stack = _record_stack()
+        worker_stack.append(parent)
+        try:
+            return function(*args, **kwargs)
+        finally:
+            worker_stack.remove(parent)
+    return wrapper
+
+
+def timed(function):
+    """
+    Decorator for hot functions so they show up inside their stage in the metrics report. Rows out
+    are filled in when the function returns a dataframe or is a generator of dataframes. A generator's
+    record spans its whole iteration, so it includes the time the consumer spends on each chunk
+    """
+    if inspect.isgeneratorfunction(function):
+        @functools.wraps(function)
+        def generator_wrapper(*args, **kwargs):
+            with track(function.__name__) as record:
+                record[ROWS_OUT_KEY] = 0
+                for chunk in function(*args, **kwargs):
+                    record[ROWS_OUT_KEY] += getattr(chunk, 'shape', (0,))[0]
+                    yield chunk
+        return generator_wrapper
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        with track(function.__name__) as record:
+            result = function(*args, **kwargs)
+            if hasattr(result, 'shape'):
+                record[ROWS_OUT_KEY] = result.shape[0]
+            return result
+    return wrapper
+
+
+@contextmanager
+def profile(name: str, folder: str):
+    """
+    Runs the enclosed block under cProfile, saving the stats to <folder>/<name>.prof and printing
+    the most expensive functions by cumulative time
+    :param name: name of the stage being profiled
+    :param folder: folder to save stats to
+    :return: None
+    """
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        os.makedirs(folder, exist_ok=True)
+        stats_file = os.path.join(folder, f'{name}.prof')
+        profiler.dump_stats(stats_file)
+        print(f"Profile for {name} saved to {stats_file}")
+        pstats.Stats(profiler).sort_stats('cumulative').print_stats(PROFILE_STATS_LINES)
+
+
+def flatten_records(records: [dict]) -> [dict]:
+    """
+    Turns nested stage records into one row per stage and per function for the CSV report
+    :param records: list of stage records
+    :return: list of flat dictionaries
+    """
+    rows = []
+
+    def add(record, stage_name):
+        rows.append({**{key: record.get(key) for key in REPORT_FIELDS}, STAGE_KEY: stage_name})
+        for child in record.get(CHILDREN_KEY, []):
+            add(child, stage_name)
+
+    for stage_record in records:
+        add(stage_record, stage_record[NAME_KEY])
+    return rows
+
+
+def write_report(records: [dict], folder: str) -> None:
+    """
+    Writes the metrics of a build as nested JSON and as a flat CSV
+    :param records: list of stage records
+    :param folder: folder to write the reports to
+    :return: None, writes files
+    """
+    os.makedirs(folder, exist_ok=True)
+    with open(os.path.join(folder, METRICS_JSON_FILE), 'w') as f:
+        json.dump(records, f, indent=2)
+    with open(os.path.join(folder, METRICS_CSV_FILE), 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=REPORT_FIELDS)
+        writer.writeheader()
+        writer.writerows(flatten_records(records))
+    print(f"Build metrics written to {folder}")
@@ -0,0 +1,214 @@
+import os
+import multiprocessing
+import concurrent.futures as futures
+from contextlib import nullcontext, closing
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List
+from data_integration.connections.databases import db_connection
+from data_integration.connections.bulk_load import copy_dataframe
+from build_pipeline.writers import write_chunks, CSV
+from build_pipeline.cache import StageCache, fingerprint_stage
+from build_pipeline.metrics import track, profile, new_record, write_report, ROWS_OUT_KEY, BYTES_KEY, WALL_KEY, \
+    FAILED, SKIPPED
+
+# Executor used for a stage. I/O stages wait on the ECE database or remote APIs and share a thread pool,
+# CPU stages spend their time in pandas and get their own process so they don't fight over the GIL
+IO_STAGE = 'io'
+CPU_STAGE = 'cpu'
+VALID_STAGE_TYPES = [IO_STAGE, CPU_STAGE]
+
+DEFAULT_IO_WORKERS = 4
+DEFAULT_CPU_WORKERS = 2
+
+# CPU stage processes start from a clean server process instead of being forked from the scheduler, where I/O stage
+# threads may hold the engine, logging or SSL locks and leave them locked forever in the child
+CPU_START_METHOD = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+
+
+@dataclass
+class Stage:
+    """
+    A single step of the build, the function takes no arguments and returns the dataframe to write to output,
+    or an iterable of dataframe chunks that are written as they arrive.
+    Inputs are the files and directories the output is built from and are used to skip unchanged stages,
+    remote stages also pull from a database or API that can't be fingerprinted. Stages with a table can be
+    loaded straight into the dashboard database
+    """
+    name: str
+    function: Callable
+    output: str
+    stage_type: str = IO_STAGE
+    depends_on: List[str] = field(default_factory=list)
+    description: str = ''
+    inputs: List[str] = field(default_factory=list)
+    remote: bool = False
+    keep_index: bool = False
+    output_format: str = CSV
+    table: str = None
+
+
+def validate_stages(stages: List[Stage]) -> None:
+    """
+    Checks that stage names are unique, stage types are known and every dependency exists and is acyclic
+    :param stages: list of stages making up the build
+    :return: None, raises an exception for an invalid graph
+    """
+    stage_dict = {}
+    for stage in stages:
+        if stage.name in stage_dict:
+            raise Exception(f"Stage {stage.name} is defined more than once")
+        if stage.stage_type not in VALID_STAGE_TYPES:
+            raise Exception(f"{stage.stage_type} is not a valid stage type, only {','.join(VALID_STAGE_TYPES)} are allowed.")
+        stage_dict[stage.name] = stage
+
+    for stage in stages:
+        missing = [x for x in stage.depends_on if x not in stage_dict]
+        if missing:
+            raise Exception(f"Stage {stage.name} depends on unknown stages {','.join(missing)}")
+
+    # Depth first search for cycles
+    visiting, visited = set(), set()
+
+    def visit(name):
+        if name in visited:
+            return
+        if name in visiting:
+            raise Exception(f"Stage dependencies contain a cycle through {name}")
+        visiting.add(name)
+        for dependency in stage_dict[name].depends_on:
+            visit(dependency)
+        visiting.remove(name)
+        visited.add(name)
+
+    for stage in stages:
+        visit(stage.name)
+
+
+def select_stages(stages: List[Stage], names: List[str]) -> List[Stage]:
+    """
+    Reduces the graph to the requested stages and everything they depend on
+    :param stages: full list of stages
+    :param names: names of stages to keep
+    :return: list of stages in the original order
+    """
+    stage_dict = {stage.name: stage for stage in stages}
+    unknown = [x for x in names if x not in stage_dict]
+    if unknown:
+        raise Exception(f"Unknown stages {','.join(unknown)}, valid stages are {','.join(stage_dict)}")
+
+    keep = set()
+    to_check = list(names)
+    while to_check:
+        name = to_check.pop()
+        if name not in keep:
+            keep.add(name)
+            to_check.extend(stage_dict[name].depends_on)
+    return [stage for stage in stages if stage.name in keep]
+
+
+def run_stage(stage: Stage, profile_folder: str = None, load_section: str = None) -> dict:
+    """
+    Runs a single stage and writes its output, this is the function submitted to the executors so it has
+    to be importable from worker processes
+    :param stage: stage to run
+    :param profile_folder: if set the stage is run under cProfile and the stats are saved here
+    :param load_section: config section of the database to COPY the output into, nothing is loaded if None
+    :return: metrics record for the stage
+    """
+    print(f"Starting {stage.name}" + (f": {stage.description}" if stage.description else ''))
+    with track(stage.name) as record:
+        with profile(stage.name, profile_folder) if profile_folder else nullcontext():
+            result = stage.function()
+
+            # Chunks are written to the output file and loaded to the database in the same pass. Closing the
+            # chunks when the load fails deletes the partial output file right away
+            with closing(write_chunks(result, stage.output, output_format=stage.output_format,
+                                      keep_index=stage.keep_index)) as chunks:
+                if load_section and stage.table:
+                    with db_connection(section=load_section) as conn:
+                        record[ROWS_OUT_KEY] = copy_dataframe(chunks, table_name=stage.table, conn=conn)
+                else:
+                    record[ROWS_OUT_KEY] = sum(chunk.shape[0] for chunk in chunks)
+        record[BYTES_KEY] = os.path.getsize(stage.output)
+    print(f"Finished {stage.name} in {record[WALL_KEY]}s")
+    return record
+
+
+def run_stages(stages: List[Stage], io_workers: int = DEFAULT_IO_WORKERS,
+               cpu_workers: int = DEFAULT_CPU_WORKERS, cache: StageCache = None, force_rebuild: bool = False,
+               metrics_folder: str = None, profile_stages: List[str] = None, load_section: str = None) -> [dict]:
+    """
+    Runs every stage as soon as the stages it depends on have finished. I/O stages go to a thread pool and
+    CPU stages go to a process pool, so independent branches of the build run at the same time
+    :param stages: list of stages making up the build
+    :param io_workers: number of threads for I/O bound stages
+    :param cpu_workers: number of processes for CPU bound stages
+    :param cache: cache of stage fingerprints, stages whose inputs haven't changed are skipped
+    :param force_rebuild: run every stage even if the cache says it's fresh, fingerprints are still recorded
+    :param metrics_folder: folder to write the metrics report and any profiles to
+    :param profile_stages: names of stages to run under cProfile
+    :param load_section: config section of the database to load stage tables into, stages whose output was
+    built but never loaded are rerun
+    :return: metrics records for each stage, raises the first stage failure after in flight stages finish
+    """
+    validate_stages(stages)
+    pending: Dict[str, Stage] = {stage.name: stage for stage in stages}
+    finished = set()
+    fingerprints = {}
+    running = {}
+    failures = []
+    records = []
+    profile_stages = profile_stages or []
+
+    with futures.ThreadPoolExecutor(max_workers=io_workers) as io_pool, \
+            futures.ProcessPoolExecutor(max_workers=cpu_workers,
+                                        mp_context=multiprocessing.get_context(CPU_START_METHOD)) as cpu_pool:
+        executors = {IO_STAGE: io_pool, CPU_STAGE: cpu_pool}
+
+        while pending or running:
+            # Don't start anything new once a stage has failed, but let running stages wrap up
+            if not failures:
+                ready = [stage for stage in pending.values() if all(x in finished for x in stage.depends_on)]
+                for stage in ready:
+                    del pending[stage.name]
+                    if cache:
+                        fingerprints[stage.name] = fingerprint_stage(stage, [fingerprints[x] for x in stage.depends_on])
+                        require_loaded = bool(load_section and stage.table)
+                        if not force_rebuild and cache.is_fresh(stage, fingerprints[stage.name], require_loaded):
+                            print(f"Skipping {stage.name}, inputs are unchanged since {stage.output} was built")
+                            finished.add(stage.name)
+                            records.append(new_record(stage.name, status=SKIPPED))
+                            continue
+                    profile_folder = metrics_folder if stage.name in profile_stages else None
+                    future = executors[stage.stage_type].submit(run_stage, stage, profile_folder, load_section)
+                    running[future] = stage
+
+                # Skipped stages can make more stages ready without anything running
+                if not running and pending and any(all(x in finished for x in stage.depends_on)
+                                                   for stage in pending.values()):
+                    continue
+
+            if not running:
+                break
+
+            done, _ = futures.wait(running, return_when=futures.FIRST_COMPLETED)
+            for future in done:
+                stage = running.pop(future)
+                try:
+                    records.append(future.result())
+                    finished.add(stage.name)
+                    if cache:
+                        cache.record(stage, fingerprints[stage.name], loaded=bool(load_section and stage.table))
+                except Exception as e:
+                    print(f"Stage {stage.name} failed: {e}")
+                    failures.append((stage.name, e))
+                    records.append(new_record(stage.name, status=FAILED))
+
+    if metrics_folder:
+        write_report(records, metrics_folder)
+
+    if failures:
+        skipped = ','.join(pending) or 'none'
+        raise Exception(f"Build failed in stages {','.join(x[0] for x in failures)}, skipped stages: {skipped}") \
+            from failures[0][1]
+    return records
@@ -0,0 +1,174 @@
+import os
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from typing import Iterable, Union
+
+CSV = 'csv'
+PARQUET = 'parquet'
+ARROW = 'arrow'
+FILE_EXTENSIONS = {CSV: '.csv', PARQUET: '.parquet', ARROW: '.arrow'}
+VALID_FORMATS = list(FILE_EXTENSIONS)
+
+PARQUET_COMPRESSION = 'zstd'
+
+
+def output_file(folder: str, name: str, output_format: str = CSV) -> str:
+    """
+    Builds the path of an output file with the extension for its format
+    :param folder: folder the file is written to
+    :param name: file name without an extension
+    :param output_format: one of VALID_FORMATS
+    :return: file path
+    """
+    if output_format not in VALID_FORMATS:
+        raise Exception(f"{output_format} is not a valid output format, only {','.join(VALID_FORMATS)} are allowed.")
+    return f'{folder}/{name}{FILE_EXTENSIONS[output_format]}'
+
+
+def coerce_mixed_columns(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Arrow needs one type per column, object columns that mix types (e.g. counts read from Excel as
+    numbers and dashes) are written as strings. Columns of dates or booleans with missing values are
+    left alone so they keep their types in the file
+    :param df: dataframe to write
+    :return: dataframe with mixed object columns converted to strings
+    """
+    mixed_cols = [col for col in df.columns[df.dtypes == object]
+                  if pd.api.types.infer_dtype(df[col], skipna=True).startswith('mixed')]
+    if mixed_cols:
+        df = df.copy()
+        for col in mixed_cols:
+            df[col] = df[col].where(df[col].isna(), df[col].astype(str))
+    return df
+
+
+def get_chunk_schema(table: pa.Table) -> pa.Schema:
+    """
+    Builds the file schema from the first chunk. Columns that are entirely null in the first chunk are
+    typed as strings and categoricals are stored by value since later chunks can have other categories
+    :param table: first chunk as an Arrow table
+    :return: schema every chunk is cast to
+    """
+    fields = []
+    for schema_field in table.schema:
+        if pa.types.is_dictionary(schema_field.type):
+            schema_field = schema_field.with_type(schema_field.type.value_type)
+        if pa.types.is_null(schema_field.type):
+            schema_field = schema_field.with_type(pa.string())
+        fields.append(schema_field)
+    return pa.schema(fields)
+
+
+class ChunkWriter:
+    """
+    Appends dataframe chunks to a single file so a stage never has to hold its whole output. The file is
+    written under a temporary name and only moved into place once close is called
+    """
+
+    def __init__(self, file_name: str, output_format: str = CSV, keep_index: bool = False):
+        if output_format not in VALID_FORMATS:
+            raise Exception(f"{output_format} is not a valid output format, only {','.join(VALID_FORMATS)} are allowed.")
+        self.file_name = file_name
+        self.temp_file = file_name + '.tmp'
+        self.output_format = output_format
+        self.keep_index = keep_index
+        self.rows = 0
+        self.schema = None
+        self.writer = None
+        self.has_header = False
+
+    def write(self, chunk: pd.DataFrame) -> None:
+        if self.output_format == CSV:
+            chunk.to_csv(self.temp_file, index=self.keep_index, mode='a' if self.has_header else 'w',
+                         header=not self.has_header)
+            self.has_header = True
+        else:
+            chunk = coerce_mixed_columns(chunk.reset_index() if self.keep_index else chunk.reset_index(drop=True))
+            chunk.columns = [str(x) for x in chunk.columns]
+            table = pa.Table.from_pandas(chunk, preserve_index=False)
+            if self.writer is None:
+                self.schema = get_chunk_schema(table)
+                if self.output_format == PARQUET:
+                    self.writer = pq.ParquetWriter(self.temp_file, self.schema, compression=PARQUET_COMPRESSION)
+                else:
+                    # Uncompressed Arrow IPC files can be memory mapped by readers
+                    self.writer = pa.ipc.new_file(self.temp_file, self.schema)
+            self.writer.write_table(table.cast(self.schema))
+        self.rows += chunk.shape[0]
+
+    def close(self, empty_frame: pd.DataFrame = None) -> int:
+        """
+        Finishes the file and moves it into place
+        :param empty_frame: frame with the output columns to write if no chunks were written
+        :return: number of rows written
+        """
+        if self.writer is None and not self.has_header:
+            self.write(empty_frame if empty_frame is not None else pd.DataFrame())
+        if self.writer is not None:
+            self.writer.close()
+        os.replace(self.temp_file, self.file_name)
+        return self.rows
+
+    def abort(self) -> None:
+        """
+        Closes the file and deletes it so a failed stage doesn't leave partial output, which can hold PII, behind
+        """
+        if self.writer is not None:
+            try:
+                self.writer.close()
+            except Exception:
+                pass
+        if os.path.exists(self.temp_file):
+            os.remove(self.temp_file)
+
+
+def iterate_frames(data: Union[pd.DataFrame, Iterable[pd.DataFrame]]):
+    """
+    Lets stages return either a whole dataframe or an iterable of dataframe chunks
+    :param data: dataframe or iterable of dataframes
+    :return: iterator of dataframes
+    """
+    if isinstance(data, pd.DataFrame):
+        return iter([data])
+    return iter(data)
+
+
+def write_chunks(data: Union[pd.DataFrame, Iterable[pd.DataFrame]], file_name: str, output_format: str = CSV,
+                 keep_index: bool = False):
+    """
+    Writes each chunk as it arrives and passes it on, so a second consumer such as a database load can
+    run in the same pass. The file is only moved into place once every chunk has been consumed, if the chunks
+    fail or the consumer stops early the partial file is deleted
+    :param data: dataframe or iterable of dataframes
+    :param file_name: path to write to
+    :param output_format: one of VALID_FORMATS
+    :param keep_index: whether to write the index as a column, chunks are yielded with it reset into a column
+    :return: generator of the written chunks
+    """
+    writer = ChunkWriter(file_name, output_format=output_format, keep_index=keep_index)
+    last_chunk = None
+    try:
+        for chunk in iterate_frames(data):
+            writer.write(chunk)
+            last_chunk = chunk
+            yield chunk.reset_index() if keep_index else chunk
+        writer.close(empty_frame=last_chunk.head(0) if last_chunk is not None else None)
+    except BaseException:
+        # Also runs when the generator is closed before the last chunk
+        writer.abort()
+        raise
+
+
+def write_frame(data: Union[pd.DataFrame, Iterable[pd.DataFrame]], file_name: str, output_format: str = CSV,
+                keep_index: bool = False) -> int:
+    """
+    Writes a stage's dataframe, or chunks of it, in the requested format. Parquet is compressed and keeps column
+    types, Arrow IPC is uncompressed so notebooks can memory map it, CSV is what the Superset upload takes
+    :param data: dataframe or iterable of dataframes
+    :param file_name: path to write to
+    :param output_format: one of VALID_FORMATS
+    :param keep_index: whether to write the index as a column
+    :return: number of rows written
+    """
+    return sum(chunk.shape[0] for chunk in write_chunks(data, file_name, output_format, keep_index))
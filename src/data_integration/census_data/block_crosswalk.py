@@ -0,0 +1,103 @@
+import os
+import hashlib
+import pandas as pd
+import geopandas as gpd
+from shapefiles import build_level_df, get_geo_data_zip_file, get_processed_file, REFERENCE_DICT, TOWN, SENATE, \
+    HOUSE, BLOCK, TIGER, FINAL_GEO_ID, CT_EPSG_CODE, DATA_FOLDER
+
+FILE_DIR = os.path.dirname(os.path.realpath(__file__))
+CROSSWALK_FOLDER = f'{FILE_DIR}/{DATA_FOLDER}/crosswalk'
+CROSSWALK_TABLE = 'block_group_crosswalk'
+
+# Levels block groups are mapped to
+CROSSWALK_LEVELS = [TOWN, SENATE, HOUSE]
+
+# Crosswalk columns
+BLOCK_GEO_ID = 'block_geo_id'
+GEO_LEVEL = 'geo_level'
+GEO_ID = 'geo_id'
+AREA_WEIGHT = 'area_weight'
+CROSSWALK_COLUMNS = [BLOCK_GEO_ID, GEO_LEVEL, GEO_ID, AREA_WEIGHT]
+
+# Overlaps smaller than this share of a block group are slivers from boundaries drawn at different resolutions
+MIN_WEIGHT = 0.001
+# Block groups with at least this share in one shape are treated as nested in it
+NESTED_WEIGHT = 0.99
+
+# Crosswalks already read by this process, keyed by file
+_crosswalk_memo = {}
+
+
+def get_crosswalk_file(file_type: str = TIGER) -> str:
+    """
+    Names the crosswalk by the shapefiles it's built from, so downloading any of them again rebuilds it
+    :param file_type: Flavor of shapefile (TIGER, cartographic lines)
+    :return: path of the crosswalk CSV
+    """
+    hasher = hashlib.sha256()
+    for geo_level in [BLOCK] + CROSSWALK_LEVELS:
+        zip_file_name = get_geo_data_zip_file(url=REFERENCE_DICT[geo_level][file_type], geo_type=geo_level,
+                                              file_type=file_type)
+        hasher.update(get_processed_file(zip_file_name)[0].encode())
+    return f'{CROSSWALK_FOLDER}/{CROSSWALK_TABLE}_{file_type}.{hasher.hexdigest()[:16]}.csv'
+
+
+def build_crosswalk(file_type: str = TIGER) -> pd.DataFrame:
+    """
+    Intersects block groups with towns and legislative districts. Areas are measured in the Connecticut projection
+    and each weight is the share of the block group's area in the shape, so block group data can be apportioned
+    :param file_type: Flavor of shapefile (TIGER, cartographic lines)
+    :return: dataframe with one row per block group and overlapping shape
+    """
+    block_df = build_level_df(geo_level=BLOCK, file_type=file_type)[[FINAL_GEO_ID, 'geometry']]
+    block_df = block_df.to_crs(epsg=CT_EPSG_CODE).rename(columns={FINAL_GEO_ID: BLOCK_GEO_ID})
+    block_areas = block_df.set_index(BLOCK_GEO_ID).area
+
+    df_list = []
+    for geo_level in CROSSWALK_LEVELS:
+        print(f"Intersecting block groups with {geo_level}")
+        level_df = build_level_df(geo_level=geo_level, file_type=file_type)[[FINAL_GEO_ID, 'geometry']]
+        level_df = level_df.to_crs(epsg=CT_EPSG_CODE).rename(columns={FINAL_GEO_ID: GEO_ID})
+        overlap_df = gpd.overlay(block_df, level_df, how='intersection')
+        overlap_df[AREA_WEIGHT] = overlap_df.area / overlap_df[BLOCK_GEO_ID].map(block_areas)
+        overlap_df = overlap_df[overlap_df[AREA_WEIGHT] >= MIN_WEIGHT]
+
+        # Weights of each block group add up to one once slivers are dropped
+        overlap_df[AREA_WEIGHT] = overlap_df[AREA_WEIGHT] / overlap_df.groupby(BLOCK_GEO_ID)[AREA_WEIGHT].transform('sum')
+        overlap_df[GEO_LEVEL] = geo_level
+        df_list.append(pd.DataFrame(overlap_df[CROSSWALK_COLUMNS]))
+
+    return pd.concat(df_list).sort_values([GEO_LEVEL, BLOCK_GEO_ID, AREA_WEIGHT], ascending=[True, True, False])
+
+
+def get_crosswalk(file_type: str = TIGER, rebuild: bool = False) -> pd.DataFrame:
+    """
+    Reads the block group crosswalk, building and saving it first if the shapefiles changed
+    :param file_type: Flavor of shapefile (TIGER, cartographic lines)
+    :param rebuild: Whether to build it again regardless
+    :return: crosswalk dataframe
+    """
+    crosswalk_file = get_crosswalk_file(file_type)
+    if not rebuild and crosswalk_file in _crosswalk_memo:
+        return _crosswalk_memo[crosswalk_file].copy()
+
+    if rebuild or not os.path.exists(crosswalk_file):
+        crosswalk_df = build_crosswalk(file_type)
+        os.makedirs(CROSSWALK_FOLDER, exist_ok=True)
+        crosswalk_df.to_csv(crosswalk_file + '.tmp', index=False)
+        os.replace(crosswalk_file + '.tmp', crosswalk_file)
+        print(f"Saved block group crosswalk to {crosswalk_file}")
+    crosswalk_df = pd.read_csv(crosswalk_file, dtype={BLOCK_GEO_ID: str, GEO_ID: str})
+    _crosswalk_memo[crosswalk_file] = crosswalk_df
+    return crosswalk_df.copy()
+
+
+def get_nested_lookup(crosswalk_df: pd.DataFrame) -> dict:
+    """
+    Finds the shape each block group nests in at every level. Block groups split between shapes are left out
+    so points in them can be tested against the shapes directly
+    :param crosswalk_df: crosswalk from get_crosswalk
+    :return: dictionary of geographic level to a series of shape IDs indexed by block group ID
+    """
+    nested_df = crosswalk_df[crosswalk_df[AREA_WEIGHT] >= NESTED_WEIGHT]
+    return {geo_level: level_df.set_index(BLOCK_GEO_ID)[GEO_ID] for geo_level, level_df in nested_df.groupby(GEO_LEVEL)}
@@ -1,10 +1,21 @@
 import os
+import time
+import threading
 import requests
 import pandas as pd
-from math import ceil
-from io import StringIO
+import concurrent.futures as futures
+from io import StringIO, BytesIO
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
 import geopandas as gpd
-from shapefiles import build_level_df, TOWN, TIGER, HOUSE, SENATE, BLOCK, DEFAULT_LAT_LONG_PROJ, FINAL_GEO_ID
+from build_pipeline.metrics import timed, add_rows_in, bind_record
+from geo_assigner import GeographyAssigner
+from block_crosswalk import get_crosswalk, get_nested_lookup
+from local_geocoder import LocalGeocoder
+from geocode_checkpoint import GeocodeCheckpoint, fingerprint_batch
+from town_fallback import resolve_missing_towns
+from geocode_cache import GeocodeCache, build_address_key, empty_results, ADDRESS_KEY, RESULT_FIELDS
+from shapefiles import build_level_df, TOWN, TIGER, HOUSE, SENATE, BLOCK, DEFAULT_LAT_LONG_PROJ
 
 FILE_DIR = os.path.dirname(os.path.realpath(__file__))
 
@@ -12,8 +23,18 @@ FILE_DIR = os.path.dirname(os.path.realpath(__file__))
 MAX_SIZE = 10000
 CENSUS_GEOCODE_URL = 'https://geocoding.geo.census.gov/geocoder/locations/addressbatch'
 
+# Batches sent to the geocoder at the same time, each one can take minutes
+GEOCODE_WORKERS = 4
+MAX_RETRIES = 4
+BACKOFF_SECONDS = 5
+REQUEST_TIMEOUT_SECONDS = 1800
+# Status the geocoder answers with when it's rate limiting, retried after the wait it asks for
+TOO_MANY_REQUESTS = 429
 
-UPLOAD_FILE_DIRECTORY = FILE_DIR + '/upload_files'
+# Census sends batches to the remote API, local interpolates along TIGER address ranges offline
+CENSUS_BACKEND = 'census'
+LOCAL_BACKEND = 'local'
+GEOCODE_BACKENDS = [CENSUS_BACKEND, LOCAL_BACKEND]
 
 # Column from shapefiles with unique identifier
 GEOID = 'geoid'
@@ -34,109 +55,203 @@ ZIP_CODE_COL = 'zip_code'
 INPUT_COLUMNS = [CHILD_ID, ADDRESS_COL, CITY_COL, STATE_COL, ZIP_CODE_COL]
 
 LOCATION_FIELDS = [CHILD_ID, 'input_address', MATCH_IDENTIFIER , 'match_type', 'match_address', LOCATION_IDENTIFIER, 'tiger_line_id', 'tiger_line_side_id']
+RESULT_DTYPES = {'input_address': str, MATCH_IDENTIFIER: 'category', 'match_type': 'category', 'match_address': str,
+                 LOCATION_IDENTIFIER: str, 'tiger_line_id': 'Int64', 'tiger_line_side_id': 'category'}
 
 
-def get_bulk_data_upload_from_census(filename: str) -> pd.DataFrame:
+# Each geocoding thread keeps its own session so connections are reused between its batches
+_local = threading.local()
+
+
+def get_session() -> requests.Session:
+    if not hasattr(_local, 'session'):
+        _local.session = requests.Session()
+    return _local.session
+
+
+def get_wait_seconds(attempt: int, retry_after: str = None) -> float:
+    """
+    Waits as long as the geocoder asks for in a Retry-After header, otherwise backs off exponentially
+    :param attempt: number of failed attempts before this one, starting at 0
+    :param retry_after: Retry-After header, either seconds or an HTTP date
+    :return: seconds to wait before the next attempt
+    """
+    if retry_after:
+        if retry_after.strip().isdigit():
+            return int(retry_after)
+        try:
+            return max((parsedate_to_datetime(retry_after) - datetime.now(timezone.utc)).total_seconds(), 0)
+        except (TypeError, ValueError):
+            pass
+    return BACKOFF_SECONDS * 2 ** attempt
+
+
+def post_with_retries(url: str, batch_name: str, batch: bytes, payload: dict) -> str:
     """
-    Uploads data in the CSV at filename and calls the Census API with
-    :param filename: name of
-    :return:
+    Posts a batch to the geocoder, retrying with exponential backoff on connection errors, timeouts, responses
+    cut off part way and server errors. Rate limited requests are retried after the wait the geocoder asks for
+    :param url: geocoder endpoint
+    :param batch_name: file name the batch is uploaded as
+    :param batch: CSV contents to upload
+    :param payload: form fields sent with the file
+    :return: text of the response
     """
+    for attempt in range(MAX_RETRIES + 1):
+        retry_after = None
+        try:
+            files = {'addressFile': (batch_name, BytesIO(batch), 'text/csv')}
+            r = get_session().post(url, data=payload, files=files, timeout=REQUEST_TIMEOUT_SECONDS)
+            if r.status_code == TOO_MANY_REQUESTS:
+                retry_after = r.headers.get('Retry-After')
+            elif r.status_code < 500:
+                r.raise_for_status()
+                return r.text
+            error = f"status {r.status_code}"
+        except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError) as e:
+            error = str(e)
+        if attempt == MAX_RETRIES:
+            raise Exception(f"Geocoding {batch_name} failed after {MAX_RETRIES + 1} attempts: {error}")
+        wait_seconds = get_wait_seconds(attempt, retry_after)
+        print(f"Geocoding {batch_name} failed ({error}), retrying in {wait_seconds} seconds")
+        time.sleep(wait_seconds)
+
+
+def serialize_batch(df: pd.DataFrame) -> bytes:
+    """
+    Validates one batch of addresses and writes it once, in memory, in the format the Census batch geocoder accepts
+    so addresses never touch the disk
+    :param df: dataframe of no more than MAX_SIZE rows with a child ID, address, town, state and zip code
+    :return: CSV contents without a header
+    """
+    upload_df = df[[CHILD_ID, ADDRESS_COL, TOWN_COL, STATE_COL, ZIP_CODE_COL]]
+    if upload_df.shape[0] > MAX_SIZE:
+        raise Exception(f"Geocoding batches are limited to {MAX_SIZE} rows, got {upload_df.shape[0]}")
+    return upload_df.to_csv(index=False, header=False).encode()
 
-    # Validate input file
-    input_df = pd.read_csv(filename, names=INPUT_COLUMNS)
-    n_rows, n_columns = input_df.shape
-    if n_columns != len(INPUT_COLUMNS) or n_rows > MAX_SIZE:
-        raise Exception(f"Improperly formatted input file {filename}")
 
+def type_results(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Converts geocoder fields read as text, from the API or the cache, to their types
+    :param df: dataframe with some of the columns in RESULT_DTYPES
+    :return: typed dataframe
+    """
+    for col, dtype in RESULT_DTYPES.items():
+        if col not in df.columns:
+            continue
+        if dtype == 'Int64':
+            df[col] = pd.to_numeric(df[col]).astype(dtype)
+        elif dtype == str:
+            df[col] = df[col].where(df[col].isna(), df[col].astype(str))
+        else:
+            df[col] = df[col].astype(dtype)
+    return df
+
+
+@timed
+def get_bulk_data_upload_from_census(batch: bytes, batch_name: str, url: str = CENSUS_GEOCODE_URL) -> pd.DataFrame:
+    """
+    Uploads a batch of addresses and parses the Census API response
+    :param batch: CSV contents from serialize_batch
+    :param batch_name: name used for the upload and progress messages
+    :param url: geocoder endpoint, can point at a local stand in for testing
+    :return: dataframe of LOCATION_FIELDS
+    """
     payload = {'benchmark': 'Public_AR_Current', 'vintage': 'Current_Current'}
-    print(f"Uploading {filename}")
-    with open(filename, 'rb') as rf:
-        files = {'addressFile': rf}
-        r = requests.post(CENSUS_GEOCODE_URL, data=payload, files=files)
-        returned_text = r.text
-    output_df = pd.read_csv(StringIO(returned_text), names=LOCATION_FIELDS)
-    print(f"{filename} geocoded")
-
-    # Delete file
-    os.remove(filename)
-
-    # Get lat/lon lon
-    output_df[['lat', 'lon']] = output_df[LOCATION_IDENTIFIER].str.split(',', expand=True)
+    print(f"Uploading {batch_name}")
+    returned_text = post_with_retries(url, batch_name, batch, payload)
+    output_df = pd.read_csv(StringIO(returned_text), names=LOCATION_FIELDS, dtype=str, keep_default_na=False,
+                            na_values=[''])
+    print(f"{batch_name} geocoded")
+    return type_results(output_df)
+
+
+def get_batch_geocoder(backend: str = CENSUS_BACKEND, url: str = CENSUS_GEOCODE_URL):
+    """
+    Picks the function batches of addresses are geocoded with
+    :param backend: one of GEOCODE_BACKENDS
+    :param url: Census geocoder endpoint, only used by the census backend
+    :return: function taking a batch dataframe and batch name and returning a dataframe of LOCATION_FIELDS
+    """
+    if backend == CENSUS_BACKEND:
+        return lambda batch_df, batch_name: get_bulk_data_upload_from_census(serialize_batch(batch_df), batch_name, url)
+    if backend == LOCAL_BACKEND:
+        # Address ranges are loaded once and shared by every batch
+        local_geocoder = LocalGeocoder()
+        return lambda batch_df, batch_name: type_results(
+            local_geocoder.geocode(batch_df, id_col=CHILD_ID, address_col=ADDRESS_COL, zip_col=ZIP_CODE_COL))
+    raise Exception(f"{backend} is not a valid geocoder, only {','.join(GEOCODE_BACKENDS)} are allowed.")
+
+
+def add_geometry(output_df: pd.DataFrame) -> gpd.GeoDataFrame:
+    """
+    Builds points from the coordinates the geocoder returned
+    :param output_df: dataframe with the geocoder's match location
+    :return: geodataframe in the default lat/long projection
+    """
+    # Get lat/lon lon, unmatched addresses have no location
+    output_df[['lat', 'lon']] = output_df[LOCATION_IDENTIFIER].str.extract(r'^([^,]+),(.+)$').astype(float)
     geo_output = gpd.GeoDataFrame(output_df, geometry=gpd.points_from_xy(output_df.lat, output_df.lon))
     geo_output = geo_output.set_crs(DEFAULT_LAT_LONG_PROJ)
     return geo_output
 
 
-def join_geo_df(student_df, geo_df, geo_name_col, geo_name):
-
-    joined_df = gpd.sjoin(geo_df[[geo_name_col, 'geometry']], student_df, how='right', op='intersects')
-    joined_df.rename(columns={geo_name_col: geo_name}, inplace=True)
-    joined_df.drop(['index_left'], axis=1, inplace=True)
-    return joined_df
+def get_geo_id_column(geo_level: str) -> str:
+    """
+    Names the column holding a level's geo ID in the geocode output, matching analytics_tables/ece_geography.sql
+    :param geo_level: level (TOWN, leg etc.)
+    :return: column name, e.g. county_subdivision_geoid
+    """
+    return geo_level.replace(' ', '_') + f'_{GEOID}'
 
 
+@timed
 def join_geos(student_df, geo_level_list, geo_type=TIGER):
 
+    # Every level is looked up in one pass over the points, without copying the student data. Towns and districts
+    # come from the block group crosswalk, only points in block groups split between them are tested against them
+    level_dfs = {geo_level: build_level_df(geo_level=geo_level, file_type=geo_type) for geo_level in geo_level_list}
+    nested_lookup = get_nested_lookup(get_crosswalk(file_type=geo_type)) if BLOCK in geo_level_list else None
+    level_ids = GeographyAssigner(level_dfs).assign(student_df.geometry, nested_lookup=nested_lookup,
+                                                    nesting_level=BLOCK)
+
     geo_level_id_list = []
     for geo_level in geo_level_list:
-        geo_df = build_level_df(geo_level=geo_level, file_type=geo_type)
-
         # Add the geoid from the census shapefile to student data for joins to shapefiles in the database
-        new_geo_level_name = geo_level.replace(' ','_') + f'_{FINAL_GEO_ID.lower()}'
+        new_geo_level_name = get_geo_id_column(geo_level)
         geo_level_id_list.append(new_geo_level_name)
-        student_df = join_geo_df(student_df=student_df, geo_df=geo_df, geo_name_col=FINAL_GEO_ID, geo_name=new_geo_level_name)
+        student_df[new_geo_level_name] = level_ids[geo_level]
 
-        # For towns attempt to join on town name as well
+        # For towns fall back to the town name and zip code entered for children the geocoder couldn't place
         if geo_level == TOWN:
-            town_df = geo_df[geo_df[NAME_SHAPEFILE] != 'County subdivisions not defined'][[NAME_SHAPEFILE,FINAL_GEO_ID]]
-            # Create lookup for exact match town names
-            town_df[NAME_SHAPEFILE] = town_df[NAME_SHAPEFILE].str.lower().str.strip()
-            town_lookup = town_df.set_index(NAME_SHAPEFILE).to_dict(orient='index')
-
-            def get_town_name_from_lookup(row):
-                """
-                Get town name if the geo code didn't identify one
-                :param row:
-                :return:
-                """
-                current_town_name = row[new_geo_level_name]
-
-                # All null values will be nan
-                if row[MATCH_IDENTIFIER] != 'No_Match':
-                    return current_town_name
-                else:
-                    input_town = row[TOWN_COL].lower().strip() if row[TOWN_COL] else None
-                    found_town_id = town_lookup.get(input_town, {FINAL_GEO_ID: None})[FINAL_GEO_ID]
-                    return found_town_id
-
-            student_df[new_geo_level_name] = student_df.apply(lambda row: get_town_name_from_lookup(row), axis=1)
+            student_df[new_geo_level_name] = resolve_missing_towns(town_ids=student_df[new_geo_level_name],
+                                                                   input_towns=student_df[TOWN_COL],
+                                                                   zip_codes=student_df[ZIP_CODE_COL],
+                                                                   town_df=level_dfs[TOWN])
 
     return student_df, geo_level_id_list
 
 
-def split_and_write_files(df, max_size: int=MAX_SIZE) -> [str]:
+def match_results(df: pd.DataFrame, results: pd.DataFrame) -> pd.DataFrame:
     """
-    Saves the passed dataframe as a set of files, each no larger than max_size
-    :param df:
-    :param max_size:
-    :return: list of filenames for saved files
+    Gives each child the geocoder result for their address, keeping the town and zip code for failed geocodes
+    :param df: dataframe of children with address keys
+    :param results: dataframe of RESULT_FIELDS indexed by address key
+    :return: dataframe of child ID, town, zip code and geocoder results
     """
-    num_rows = df.shape[0]
-    num_files = ceil(num_rows / max_size)
-    filename_list = []
-    for i in range(num_files):
-        item_filename = f"{UPLOAD_FILE_DIRECTORY}/upload_file_{i}.csv"
-        df[i*MAX_SIZE:(i+1)*MAX_SIZE].to_csv(item_filename, index=False, header=False)
-        filename_list.append(item_filename)
-
-    return filename_list
+    return df[[CHILD_ID, TOWN_COL, ZIP_CODE_COL, ADDRESS_KEY]].merge(results, how='inner', left_on=ADDRESS_KEY, right_index=True)
 
 
-def run_geo_code(db_conn) -> pd.DataFrame:
+@timed
+def run_geo_code(db_conn, workers: int = GEOCODE_WORKERS, url: str = CENSUS_GEOCODE_URL,
+                 cache_file: str = None, backend: str = CENSUS_BACKEND, checkpoint_folder: str = None) -> pd.DataFrame:
     """
     Does a full run of all the active children in the database and ties them with towns, legislative districts and census blocks
     :param db_conn: SQL alchemy connection to ECE database
+    :param workers: number of batches to geocode at the same time
+    :param url: geocoder endpoint, can point at a local stand in for testing
+    :param cache_file: SQLite file of addresses already geocoded, only addresses missing from it are submitted
+    :param backend: geocoder to use, one of GEOCODE_BACKENDS
+    :param checkpoint_folder: folder to save finished batches in, a failed run resumes from them when rerun
     :return: dataframe of child IDs and corresponding geographic entities
     """
     sql_string = f"""select c.id as {CHILD_ID}, 
@@ -147,23 +262,95 @@ def run_geo_code(db_conn) -> pd.DataFrame:
                                 from child c
                                 LEFT OUTER join family f on c.familyId = f.id
                                 where c.deletedDate is null and f.deletedDate is null
+                                order by c.id
                                 """
 
-    df = pd.read_sql(sql=sql_string, con=db_conn)
-
-    # Call bulk census API geocoder with results from SQL query, temporary files are written and removed
-    file_list = split_and_write_files(df)
-    print("Uploaded data to census")
-    df_list = [get_bulk_data_upload_from_census(filename) for filename in file_list]
-    combined_df = pd.concat(df_list)
-
-    # Add town name in as a default for failed geocodes
-    combined_df_w_town = combined_df.merge(df[[CHILD_ID,TOWN_COL]], how='inner', left_on=CHILD_ID, right_on=CHILD_ID)
+    # Rows are fetched one upload batch at a time and geocoded in parallel. Reading stops while every worker
+    # is busy so only the geocoded results are held for the whole table. Children are read in a fixed order so
+    # batches line up with the checkpoints of an earlier run
+    # Uploads run on worker threads, binding them to this record keeps their timings in the stage's metrics
+    geocode_batch = bind_record(get_batch_geocoder(backend, url))
+    cache = GeocodeCache(cache_file) if cache_file else None
+    checkpoint = GeocodeCheckpoint(checkpoint_folder) if checkpoint_folder else None
+    df_list = []
+    pending = {}
+    cached_count, submitted_count, resumed_count = 0, 0, 0
+
+    def finish_batch(batch_number, fingerprint, part_list):
+        batch_result_df = pd.concat(part_list, ignore_index=True)
+        if checkpoint:
+            checkpoint.save(batch_number, fingerprint, batch_result_df)
+        df_list.append(batch_result_df)
+
+    def collect(done, raise_errors=True):
+        errors = []
+        for future in done:
+            batch_number, fingerprint, batch_df, missed_df, cached_part = pending.pop(future)
+            try:
+                geocoded_df = future.result()
+            except Exception as e:
+                errors.append(e)
+                continue
+            # The geocoder returns the child ID that was sent with each address. The Census API returns it as text,
+            # so IDs are matched as text whatever type the database gave them
+            sent_df = batch_df[[CHILD_ID, ADDRESS_KEY]].assign(**{CHILD_ID: batch_df[CHILD_ID].astype(str)})
+            results = geocoded_df.assign(**{CHILD_ID: geocoded_df[CHILD_ID].astype(str)}) \
+                .merge(sent_df, on=CHILD_ID).set_index(ADDRESS_KEY)[RESULT_FIELDS]
+            if cache:
+                cache.store(results)
+            finish_batch(batch_number, fingerprint, [cached_part, match_results(missed_df, results)])
+        if errors and raise_errors:
+            raise errors[0]
+
+    try:
+        with futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            try:
+                for batch_number, df in enumerate(pd.read_sql(sql=sql_string, con=db_conn, chunksize=MAX_SIZE)):
+                    add_rows_in(df.shape[0])
+                    df[ADDRESS_KEY] = build_address_key(df[ADDRESS_COL], df[TOWN_COL], df[STATE_COL], df[ZIP_CODE_COL])
+
+                    fingerprint = fingerprint_batch(df[[CHILD_ID, ADDRESS_KEY]]) if checkpoint else None
+                    saved_df = checkpoint.load(batch_number, fingerprint) if checkpoint else None
+                    if saved_df is not None:
+                        df_list.append(saved_df)
+                        resumed_count += 1
+                        continue
+
+                    cached_df = type_results(cache.lookup(df[ADDRESS_KEY])) if cache else empty_results()
+                    is_cached = df[ADDRESS_KEY].isin(cached_df.index)
+                    cached_part = match_results(df[is_cached], cached_df)
+                    cached_count += is_cached.sum()
+
+                    # Children at the same address share one row in the upload
+                    batch_df = df[~is_cached].drop_duplicates(ADDRESS_KEY)
+                    if batch_df.empty:
+                        finish_batch(batch_number, fingerprint, [cached_part])
+                        continue
+                    submitted_count += batch_df.shape[0]
+                    future = executor.submit(geocode_batch, batch_df, f'upload_batch_{batch_number}.csv')
+                    pending[future] = (batch_number, fingerprint, batch_df, df[~is_cached], cached_part)
+                    if len(pending) >= workers:
+                        collect(futures.wait(pending, return_when=futures.FIRST_COMPLETED).done)
+                collect(futures.wait(pending).done)
+            except Exception:
+                # Keep the batches that were still running when the run failed so a rerun doesn't repeat them
+                collect(futures.wait(pending).done, raise_errors=False)
+                raise
+    finally:
+        if cache:
+            cache.close()
+    print(f"{resumed_count} batches resumed from checkpoints, {cached_count} children found in the geocode cache, "
+          f"{submitted_count} addresses sent to the {backend} geocoder")
+    combined_df_w_town = add_geometry(pd.concat(df_list, ignore_index=True))
 
     # Add matches for all geographies to existing student dataframe
     geo_list = [TOWN, SENATE, HOUSE, BLOCK]
     final_student_df, geo_id_list = join_geos(student_df=combined_df_w_town, geo_level_list=geo_list)
 
+    # The run is complete so the saved batches aren't needed anymore
+    if checkpoint:
+        checkpoint.finish()
+
     # Only return child ID and the corresponding joined geographic areas to preserve PII
     return final_student_df[geo_id_list + [CHILD_ID]]
 
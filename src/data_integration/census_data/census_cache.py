@@ -0,0 +1,80 @@
+import os
+import json
+import hashlib
+import pandas as pd
+import censusdata as cd
+
+FILE_DIR = os.path.dirname(os.path.realpath(__file__))
+CENSUS_CACHE_FOLDER = f'{FILE_DIR}/data/census_api'
+# Bump the version when the stored format changes so old responses are downloaded again
+CENSUS_CACHE_VERSION = '1'
+
+# Columns the censusgeo index is stored in
+GEO_NAME_COL = '_geo_name'
+GEO_PARAMS_COL = '_geo_params'
+
+
+def get_cache_file(kind: str, src: str, year: int, params: list, extension: str) -> str:
+    """
+    Names a cached response by everything that identifies the request
+    :param kind: type of request, download or censusvar
+    :param src: Census dataset, e.g. acs5
+    :param year: year of the dataset
+    :param params: anything else the response depends on, e.g. geography and fields
+    :param extension: file extension
+    :return: path of the cache file
+    """
+    key = json.dumps([CENSUS_CACHE_VERSION, kind, src, year, params])
+    return f'{CENSUS_CACHE_FOLDER}/{kind}_{src}_{year}.{hashlib.sha256(key.encode()).hexdigest()[:16]}.{extension}'
+
+
+def cached_download(src: str, year: int, geo: cd.censusgeo, var: list, tabletype: str = 'detail',
+                    refresh: bool = False) -> pd.DataFrame:
+    """
+    Same as censusdata.download but the response is kept as Parquet, so released datasets like the ACS 5 year
+    estimates are only downloaded once
+    :param src: Census dataset, e.g. acs5
+    :param year: year of the dataset
+    :param geo: censusgeo of the geographies to download
+    :param var: fields to download
+    :param tabletype: type of table the fields come from
+    :param refresh: Whether to download the response regardless
+    :return: dataframe indexed by censusgeo with one column per field
+    """
+    cache_file = get_cache_file('download', src, year, [list(geo.params()), list(var), tabletype], 'parquet')
+    if not refresh and os.path.exists(cache_file):
+        df = pd.read_parquet(cache_file)
+        df.index = [cd.censusgeo(tuple(tuple(x) for x in json.loads(params)), name)
+                    for name, params in zip(df[GEO_NAME_COL], df[GEO_PARAMS_COL])]
+        return df.drop(columns=[GEO_NAME_COL, GEO_PARAMS_COL])
+
+    df = cd.download(src, year, geo, var, tabletype=tabletype)
+    stored_df = df.reset_index(drop=True)
+    stored_df[GEO_NAME_COL] = [x.name for x in df.index]
+    stored_df[GEO_PARAMS_COL] = [json.dumps(x.params()) for x in df.index]
+    os.makedirs(CENSUS_CACHE_FOLDER, exist_ok=True)
+    stored_df.to_parquet(cache_file + '.tmp', index=False)
+    os.replace(cache_file + '.tmp', cache_file)
+    return df
+
+
+def cached_censusvar(src: str, year: int, var: list, refresh: bool = False) -> dict:
+    """
+    Same as censusdata.censusvar but the variable descriptions are kept as JSON
+    :param src: Census dataset, e.g. acs5
+    :param year: year of the dataset
+    :param var: fields to describe
+    :param refresh: Whether to download the descriptions regardless
+    :return: dictionary of field to a list of concept, label and type
+    """
+    cache_file = get_cache_file('censusvar', src, year, list(var), 'json')
+    if not refresh and os.path.exists(cache_file):
+        with open(cache_file) as f:
+            return json.load(f)
+
+    field_dicts = cd.censusvar(src, year, var)
+    os.makedirs(CENSUS_CACHE_FOLDER, exist_ok=True)
+    with open(cache_file + '.tmp', 'w') as f:
+        json.dump(field_dicts, f)
+    os.replace(cache_file + '.tmp', cache_file)
+    return field_dicts
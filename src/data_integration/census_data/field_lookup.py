@@ -1,5 +1,6 @@
 import censusdata as cd
 from numpy import nan
+from census_cache import cached_download
 
 SINGLE_FIELD_FILE = "single_field_lookups.txt"
 COMBINATION_FIELD_FILE = "combination_field_lookups.txt"
@@ -91,7 +92,7 @@ the censusgeo object.
 '''
 def handle_single_fields(geo, mapping):
     fields = list(mapping.keys())
-    dat = cd.download('acs5', 2019, geo, fields)
+    dat = cached_download('acs5', 2019, geo, fields)
     dat.rename(columns=mapping, inplace=True)
     return dat
 
@@ -125,7 +126,7 @@ def download_combination_fields(geo, tables, max_field_nums, solo_fields, combin
                 field_list.append(tables[t] + "_" + str_rep + "E")
     
     # Block download to minimize API calls
-    dat = cd.download('acs5', 2019, geo, field_list)
+    dat = cached_download('acs5', 2019, geo, field_list)
     return dat
     
 
@@ -0,0 +1,73 @@
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+from shapefiles import FINAL_GEO_ID
+
+
+class GeographyAssigner:
+    """
+    Labels points with the ID of the shape containing them at several geographic levels. The spatial index of each
+    level is built once and queried with every point at the same time, so the points are never copied or joined.
+    Needs pygeos for the bulk index queries
+    """
+
+    def __init__(self, level_dfs: dict, id_col: str = FINAL_GEO_ID):
+        """
+        :param level_dfs: dictionary of geographic level to geodataframe of its shapes, all in the same CRS
+        :param id_col: column with the ID of each shape
+        """
+        self.crs = next(iter(level_dfs.values())).crs
+        self.level_ids = {}
+        self.level_geometries = {}
+        for geo_level, level_df in level_dfs.items():
+            if level_df.crs != self.crs:
+                raise Exception(f"{geo_level} shapes are in {level_df.crs}, expected {self.crs}")
+            self.level_ids[geo_level] = level_df[id_col].to_numpy()
+            self.level_geometries[geo_level] = level_df.geometry.reset_index(drop=True)
+            # The index is built lazily by geopandas, build it here so it's only done once
+            self.level_geometries[geo_level].sindex
+
+    def assign_level(self, geo_level: str, points: gpd.GeoSeries) -> np.ndarray:
+        """
+        Finds the shape containing each point at one level. Points on a border shared by two shapes get the first one
+        :param geo_level: geographic level to look up
+        :param points: points in the assigner's CRS
+        :return: array of shape IDs aligned with points, None where no shape contains the point
+        """
+        point_index, shape_index = self.level_geometries[geo_level].sindex.query_bulk(points.values,
+                                                                                      predicate='intersects')
+        # Results are sorted by point, keep the first shape for each
+        matched_points, first_match = np.unique(point_index, return_index=True)
+        ids = np.full(len(points), None, dtype=object)
+        ids[matched_points] = self.level_ids[geo_level][shape_index[first_match]]
+        return ids
+
+    def assign(self, points: gpd.GeoSeries, nested_lookup: dict = None, nesting_level: str = None) -> dict:
+        """
+        Finds the shape containing each point at every level. With a crosswalk, points are only tested against the
+        nesting level and other levels are looked up from it, points in shapes missing from the crosswalk are
+        tested directly
+        :param points: points in the assigner's CRS
+        :param nested_lookup: dictionary of geographic level to a series of shape IDs indexed by nesting level ID
+        :param nesting_level: level the crosswalk is keyed by, e.g. block groups
+        :return: dictionary of geographic level to an array of shape IDs aligned with points
+        """
+        if points.crs is not None and points.crs != self.crs:
+            points = points.to_crs(self.crs)
+        if not nested_lookup or nesting_level not in self.level_ids:
+            return {geo_level: self.assign_level(geo_level, points) for geo_level in self.level_ids}
+
+        nesting_ids = self.assign_level(nesting_level, points)
+        level_ids = {nesting_level: nesting_ids}
+        for geo_level in self.level_ids:
+            if geo_level == nesting_level:
+                continue
+            if geo_level not in nested_lookup:
+                level_ids[geo_level] = self.assign_level(geo_level, points)
+                continue
+            ids = pd.Series(nesting_ids).map(nested_lookup[geo_level]).to_numpy(dtype=object)
+            unresolved = pd.isna(ids)
+            if unresolved.any():
+                ids[unresolved] = self.assign_level(geo_level, points[unresolved])
+            level_ids[geo_level] = ids
+        return level_ids
@@ -0,0 +1,103 @@
+import re
+import sqlite3
+import pandas as pd
+from datetime import datetime
+
+ADDRESS_KEY = 'address_key'
+GEOCODED_AT = 'geocoded_at'
+
+# Geocoder result fields kept for each address, names match LOCATION_FIELDS in bulk_geocoding
+RESULT_FIELDS = ['range_match_indicator', 'match_type', 'match_address', 'match_location', 'tiger_line_id',
+                 'tiger_line_side_id']
+
+# Only matched addresses are cached, anything else (No_Match, Tie) is sent to the geocoder again on the next run
+# since the address or the geocoder's reference data may have been fixed since
+MATCH_INDICATOR = 'range_match_indicator'
+MATCHED = 'Match'
+
+# SQLite limits the number of parameters in one statement
+LOOKUP_BATCH_SIZE = 500
+
+STREET_ABBREVIATIONS = {'street': 'st', 'avenue': 'ave', 'road': 'rd', 'drive': 'dr', 'lane': 'ln',
+                        'court': 'ct', 'place': 'pl', 'boulevard': 'blvd', 'terrace': 'ter', 'circle': 'cir',
+                        'apartment': 'apt', 'north': 'n', 'south': 's', 'east': 'e', 'west': 'w'}
+ABBREVIATION_PATTERN = re.compile(r'\b(' + '|'.join(STREET_ABBREVIATIONS) + r')\b')
+
+
+def empty_results() -> pd.DataFrame:
+    return pd.DataFrame(columns=RESULT_FIELDS, index=pd.Index([], name=ADDRESS_KEY))
+
+
+def normalize_text(column: pd.Series) -> pd.Series:
+    """
+    Lower cases, removes punctuation and collapses whitespace so trivially different spellings share a key
+    :param column: series of strings
+    :return: normalized series
+    """
+    return column.fillna('').astype(str).str.lower() \
+        .str.replace(r'[^a-z0-9 ]', ' ', regex=True) \
+        .str.replace(r'\s+', ' ', regex=True).str.strip()
+
+
+def build_address_key(street: pd.Series, town: pd.Series, state: pd.Series, zip_code: pd.Series) -> pd.Series:
+    """
+    Builds the cache key of each address from its normalized street, town, state and 5 digit zip code
+    :param street: street addresses
+    :param town: towns
+    :param state: states
+    :param zip_code: zip codes, ZIP+4 is truncated
+    :return: series of keys
+    """
+    street = normalize_text(street).str.replace(ABBREVIATION_PATTERN, lambda x: STREET_ABBREVIATIONS[x.group(1)],
+                                                regex=True)
+    zip_5 = zip_code.fillna('').astype(str).str.extract(r'(\d{5})', expand=False).fillna('')
+    return street + '|' + normalize_text(town) + '|' + normalize_text(state) + '|' + zip_5
+
+
+class GeocodeCache:
+    """
+    Keeps the geocoder result for every address already matched in a SQLite file so only new, changed or
+    unmatched addresses are sent again. The file contains addresses so it belongs with other PII
+    """
+
+    def __init__(self, cache_file: str):
+        self.cache_file = cache_file
+        self.conn = sqlite3.connect(cache_file)
+        field_list = ', '.join(f'{x} text' for x in RESULT_FIELDS)
+        self.conn.execute(f'create table if not exists geocode '
+                          f'({ADDRESS_KEY} text primary key, {field_list}, {GEOCODED_AT} text)')
+        self.conn.commit()
+
+    def lookup(self, keys: pd.Series) -> pd.DataFrame:
+        """
+        Finds cached results for a set of address keys
+        :param keys: address keys, duplicates are allowed
+        :return: dataframe of RESULT_FIELDS indexed by address key, only for matched keys in the cache
+        """
+        unique_keys = keys.dropna().unique().tolist()
+        df_list = []
+        for start in range(0, len(unique_keys), LOOKUP_BATCH_SIZE):
+            batch = unique_keys[start:start + LOOKUP_BATCH_SIZE]
+            sql = f"select {ADDRESS_KEY}, {', '.join(RESULT_FIELDS)} from geocode " \
+                  f"where {ADDRESS_KEY} in ({', '.join('?' * len(batch))}) and {MATCH_INDICATOR} = ?"
+            df_list.append(pd.read_sql(sql, self.conn, params=batch + [MATCHED]))
+        if not df_list:
+            return empty_results()
+        return pd.concat(df_list).set_index(ADDRESS_KEY)
+
+    def store(self, results: pd.DataFrame) -> None:
+        """
+        Saves matched geocoder results, replacing any earlier result for the same address
+        :param results: dataframe of RESULT_FIELDS indexed by address key
+        :return: None, writes to the cache file
+        """
+        results = results[results[MATCH_INDICATOR] == MATCHED]
+        geocoded_at = datetime.now().isoformat(timespec='seconds')
+        rows = [(key, *[None if pd.isna(x) else str(x) for x in values], geocoded_at)
+                for key, values in zip(results.index, results[RESULT_FIELDS].itertuples(index=False))]
+        placeholders = ', '.join('?' * (len(RESULT_FIELDS) + 2))
+        self.conn.executemany(f'insert or replace into geocode values ({placeholders})', rows)
+        self.conn.commit()
+
+    def close(self) -> None:
+        self.conn.close()
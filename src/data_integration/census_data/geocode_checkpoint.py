@@ -0,0 +1,79 @@
+import os
+import json
+import shutil
+import hashlib
+import pandas as pd
+from datetime import datetime
+from build_pipeline.writers import write_frame, PARQUET
+
+MANIFEST_FILE = 'manifest.json'
+BATCHES_KEY = 'batches'
+FINGERPRINT_KEY = 'fingerprint'
+ROWS_KEY = 'rows'
+FILE_KEY = 'file'
+COMPLETED_KEY = 'completed_at'
+
+
+def fingerprint_batch(df: pd.DataFrame) -> str:
+    """
+    Hashes the rows of a batch so a saved result is only reused for exactly the same addresses
+    :param df: dataframe of the columns that identify a batch's input
+    :return: hex digest
+    """
+    return hashlib.sha256(pd.util.hash_pandas_object(df, index=False).values.tobytes()).hexdigest()
+
+
+class GeocodeCheckpoint:
+    """
+    Saves the result of every geocoded batch as it finishes, along with a manifest of finished batches, so a run
+    that fails or times out picks up where it stopped. Batches contain PII so the folder belongs with other PII
+    """
+
+    def __init__(self, folder: str):
+        self.folder = folder
+        self.manifest_file = os.path.join(folder, MANIFEST_FILE)
+        self.manifest = {BATCHES_KEY: {}}
+        if os.path.exists(self.manifest_file):
+            with open(self.manifest_file) as f:
+                self.manifest = json.load(f)
+
+    def load(self, batch_number: int, fingerprint: str):
+        """
+        Reads a batch finished by an earlier run
+        :param batch_number: position of the batch in the run
+        :param fingerprint: fingerprint of the batch's input in this run
+        :return: saved result, or None if the batch has to be geocoded
+        """
+        entry = self.manifest[BATCHES_KEY].get(str(batch_number))
+        if not entry or entry[FINGERPRINT_KEY] != fingerprint:
+            return None
+        batch_file = os.path.join(self.folder, entry[FILE_KEY])
+        if not os.path.exists(batch_file):
+            return None
+        return pd.read_parquet(batch_file)
+
+    def save(self, batch_number: int, fingerprint: str, df: pd.DataFrame) -> None:
+        """
+        Writes a finished batch and records it in the manifest
+        :param batch_number: position of the batch in the run
+        :param fingerprint: fingerprint of the batch's input
+        :param df: geocoded result of the batch
+        :return: None, writes files
+        """
+        os.makedirs(self.folder, exist_ok=True)
+        file_name = f'batch_{batch_number}.parquet'
+        write_frame(df, os.path.join(self.folder, file_name), output_format=PARQUET)
+        self.manifest[BATCHES_KEY][str(batch_number)] = {FINGERPRINT_KEY: fingerprint, ROWS_KEY: df.shape[0],
+                                                         FILE_KEY: file_name,
+                                                         COMPLETED_KEY: datetime.now().isoformat(timespec='seconds')}
+        with open(self.manifest_file + '.tmp', 'w') as f:
+            json.dump(self.manifest, f, indent=2)
+        os.replace(self.manifest_file + '.tmp', self.manifest_file)
+
+    def finish(self) -> None:
+        """
+        Removes the checkpoints once the whole run has succeeded
+        :return: None, deletes the folder
+        """
+        if os.path.exists(self.folder):
+            shutil.rmtree(self.folder)
@@ -0,0 +1,154 @@
+import os
+import hashlib
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+from geocode_cache import normalize_text, ABBREVIATION_PATTERN, STREET_ABBREVIATIONS
+from shapefiles import get_geo_data_zip_file, get_processed_file, TIGER, DEFAULT_LAT_LONG_PROJ, DATA_FOLDER, \
+    PROCESSED_FOLDER
+
+FILE_DIR = os.path.dirname(os.path.realpath(__file__))
+
+# Address range features for every Connecticut county
+ADDRFEAT = 'addrfeat'
+CT_COUNTY_FIPS = ['09001', '09003', '09005', '09007', '09009', '09011', '09013', '09015']
+ADDRFEAT_URL = 'https://www2.census.gov/geo/tiger/TIGER2020/ADDRFEAT/tl_2020_{county_fips}_addrfeat.zip'
+ADDRESS_RANGE_FOLDER = f"{FILE_DIR}/{DATA_FOLDER}/{ADDRFEAT}/{TIGER}/{PROCESSED_FOLDER}"
+
+# Address range columns, one row per side of a street segment
+TIGER_LINE_ID = 'tiger_line_id'
+SIDE = 'tiger_line_side_id'
+STREET_KEY = 'street_key'
+STREET_NAME = 'street_name'
+FROM_NUMBER = 'from_number'
+TO_NUMBER = 'to_number'
+ZIP = 'zip'
+PARITY = 'parity'
+RANGE_COLUMNS = [TIGER_LINE_ID, SIDE, STREET_KEY, STREET_NAME, FROM_NUMBER, TO_NUMBER, ZIP, PARITY, 'geometry']
+
+# Unit designations after the street name aren't part of the range lookup
+UNIT_PATTERN = r'\s+(?:apt|apartment|unit|ste|suite|fl|floor|rm|room|bldg)\b.*$|\s*#.*$'
+HOUSE_NUMBER_PATTERN = r'^\s*(\d+)[a-z]?\s+(.+)$'
+
+MATCH = 'Match'
+NO_MATCH = 'No_Match'
+INTERPOLATED = 'Non_Exact'
+
+
+def normalize_street(streets: pd.Series) -> pd.Series:
+    """
+    Builds the street part of an address key the same way the geocode cache does, so TIGER names
+    like "N Main St" and entered names like "North Main Street" meet
+    :param streets: street names
+    :return: normalized street names
+    """
+    return normalize_text(streets).str.replace(ABBREVIATION_PATTERN, lambda x: STREET_ABBREVIATIONS[x.group(1)],
+                                               regex=True)
+
+
+def read_address_ranges(file_name: str) -> gpd.GeoDataFrame:
+    """
+    Splits the address ranges of one ADDRFEAT file into one row per side of each street segment
+    :param file_name: path of the downloaded zip
+    :return: geodataframe of RANGE_COLUMNS
+    """
+    df = gpd.read_file(f'zip://{file_name}')
+    df = df[df['FULLNAME'].notna()]
+    df_list = []
+    for side in ['L', 'R']:
+        side_df = gpd.GeoDataFrame({TIGER_LINE_ID: df['TLID'].astype('int64'),
+                                    SIDE: side,
+                                    STREET_NAME: df['FULLNAME'],
+                                    STREET_KEY: normalize_street(df['FULLNAME']),
+                                    FROM_NUMBER: pd.to_numeric(df[f'{side}FROMHN'], errors='coerce'),
+                                    TO_NUMBER: pd.to_numeric(df[f'{side}TOHN'], errors='coerce'),
+                                    ZIP: df[f'ZIP{side}'],
+                                    PARITY: df[f'PARITY{side}'],
+                                    'geometry': df.geometry}, crs=df.crs)
+        df_list.append(side_df[side_df[FROM_NUMBER].notna() & side_df[TO_NUMBER].notna()])
+    return pd.concat(df_list, ignore_index=True)
+
+
+def build_address_ranges(redownload: bool = False) -> gpd.GeoDataFrame:
+    """
+    Downloads the ADDRFEAT files for every county and combines them into one address range table, saved as
+    GeoParquet named by the downloaded files so it's only rebuilt when they change
+    :param redownload: Whether to download the files regardless of whether they exist locally
+    :return: geodataframe of address ranges in the default lat/long projection
+    """
+    hasher = hashlib.sha256()
+    file_list = []
+    for county_fips in CT_COUNTY_FIPS:
+        file_name = get_geo_data_zip_file(url=ADDRFEAT_URL.format(county_fips=county_fips), geo_type=ADDRFEAT,
+                                          file_type=TIGER, redownload=redownload)
+        hasher.update(get_processed_file(file_name)[0].encode())
+        file_list.append(file_name)
+
+    range_file = f'{ADDRESS_RANGE_FOLDER}/address_ranges.{hasher.hexdigest()[:16]}.parquet'
+    if os.path.exists(range_file):
+        return gpd.read_parquet(range_file)
+
+    print(f"Building address ranges from {len(file_list)} county files")
+    range_df = pd.concat([read_address_ranges(x) for x in file_list], ignore_index=True).to_crs(epsg=DEFAULT_LAT_LONG_PROJ)
+    os.makedirs(ADDRESS_RANGE_FOLDER, exist_ok=True)
+    range_df.to_parquet(range_file + '.tmp')
+    os.replace(range_file + '.tmp', range_file)
+    return range_df
+
+
+class LocalGeocoder:
+    """
+    Geocodes addresses offline by interpolating house numbers along TIGER address ranges. Returns the same fields
+    as the Census batch geocoder so it can replace it in run_geo_code
+    """
+
+    def __init__(self, range_df: gpd.GeoDataFrame = None):
+        range_df = (build_address_ranges() if range_df is None else range_df).reset_index(drop=True)
+        self.geometry = range_df.geometry
+        # Indexing by street and zip keeps each batch's merge to the candidate segments
+        self.range_df = pd.DataFrame(range_df.drop(columns='geometry')).assign(range_row=np.arange(range_df.shape[0])) \
+            .set_index([STREET_KEY, ZIP]).sort_index()
+
+    def geocode(self, df: pd.DataFrame, id_col: str, address_col: str, zip_col: str) -> pd.DataFrame:
+        """
+        Finds the segment side whose range covers each house number on the same street and zip code and
+        interpolates a point along it
+        :param df: dataframe of addresses
+        :param id_col: column identifying each address, returned with the results
+        :param address_col: column with the house number and street
+        :param zip_col: column with the zip code
+        :return: dataframe with the Census batch geocoder's fields, one row per address
+        """
+        addresses = df[address_col].fillna('').astype(str).str.lower().str.replace(UNIT_PATTERN, '', regex=True)
+        parts = addresses.str.extract(HOUSE_NUMBER_PATTERN)
+        address_df = pd.DataFrame({id_col: df[id_col].values,
+                                   'input_address': df[address_col].values,
+                                   'house_number': pd.to_numeric(parts[0], errors='coerce').values,
+                                   STREET_KEY: normalize_street(parts[1]).values,
+                                   ZIP: df[zip_col].fillna('').astype(str).str.extract(r'(\d{5})', expand=False).values})
+
+        candidate_df = address_df.dropna(subset=['house_number', ZIP]) \
+            .merge(self.range_df, left_on=[STREET_KEY, ZIP], right_index=True)
+        low = candidate_df[[FROM_NUMBER, TO_NUMBER]].min(axis=1)
+        high = candidate_df[[FROM_NUMBER, TO_NUMBER]].max(axis=1)
+        number = candidate_df['house_number']
+        parity_ok = candidate_df[PARITY].isin(['B']) | candidate_df[PARITY].isna() | \
+            ((candidate_df[PARITY] == 'E') & (number % 2 == 0)) | ((candidate_df[PARITY] == 'O') & (number % 2 == 1))
+        match_df = candidate_df[(number >= low) & (number <= high) & parity_ok].drop_duplicates(id_col)
+
+        # House numbers run from the start of the segment, ranges with a single number are put at the middle
+        span = match_df[TO_NUMBER] - match_df[FROM_NUMBER]
+        fraction = ((match_df['house_number'] - match_df[FROM_NUMBER]) / span.where(span != 0)).fillna(0.5).clip(0, 1)
+        lines = gpd.GeoSeries(self.geometry.values[match_df['range_row'].values], crs=self.geometry.crs)
+        points = lines.interpolate(fraction.values, normalized=True)
+
+        match_df = match_df.assign(**{'range_match_indicator': MATCH, 'match_type': INTERPOLATED,
+                                      'match_address': match_df['house_number'].astype(int).astype(str) + ' ' +
+                                      match_df[STREET_NAME] + ', ' + match_df[ZIP],
+                                      'match_location': [f'{x},{y}' for x, y in zip(points.x, points.y)]})
+        result_df = address_df[[id_col, 'input_address']].merge(
+            match_df[[id_col, 'range_match_indicator', 'match_type', 'match_address', 'match_location',
+                      TIGER_LINE_ID, SIDE]], how='left', on=id_col)
+        result_df['range_match_indicator'] = result_df['range_match_indicator'].fillna(NO_MATCH)
+        print(f"Locally geocoded {match_df.shape[0]} of {address_df.shape[0]} addresses")
+        return result_df
@@ -1,14 +1,21 @@
+import pygeos
 import pandas as pd
 import geopandas as gpd
 import sqlalchemy
-from shapely.geometry.polygon import Polygon
-from shapely.geometry.multipolygon import MultiPolygon
-from geoalchemy2 import Geometry, WKTElement
-from shapefiles import CARTO, build_level_df, DEFAULT_LAT_LONG_PROJ, SENATE, HOUSE, FINAL_SENATE_ID, FINAL_HOUSE_ID
+from geoalchemy2 import Geometry
+from shapely.ops import linemerge, polygonize, unary_union
+from data_integration.connections.bulk_load import copy_dataframe, STAGING_SUFFIX
+from data_integration.connections.table_indexes import index_table
+from shapefiles import CARTO, build_level_df, DEFAULT_LAT_LONG_PROJ, SENATE, HOUSE, FINAL_SENATE_ID, FINAL_HOUSE_ID, \
+    FINAL_GEO_ID, CT_EPSG_CODE
 
 LEGISLATOR_RENAME = {'name': 'legislator_name',
                      'current_party': 'legislator_party'}
 GEOMETRY_COL = 'geometry'
+
+# Simplified geometry columns and their tolerance in meters of the Connecticut projection, coarse shapes for a
+# statewide map and finer ones for zooming into a town
+SIMPLIFIED_TOLERANCES = {'geometry_state': 500, 'geometry_town': 50}
 DEFAULT_SCHEMA = 'uploaded_data'
 CT_OPEN_DATA_CSV = 'https://data.openstates.org/people/current/ct.csv'
 
@@ -16,27 +23,72 @@ CT_OPEN_DATA_CSV = 'https://data.openstates.org/people/current/ct.csv'
 CURRENT_DISTRICT = 'current_district'
 
 
-def convert_to_poly(geom) -> Polygon:
+def get_largest_polygons(geometry: gpd.GeoSeries) -> gpd.GeoSeries:
     """
     Selects the largest Polygon for MultiPolygons since all CT towns are contiguous, this removes small islands
-    :param geom: Geometry object
-    :return: MultiPolygon object
+    :param geometry: series of Polygons and MultiPolygons
+    :return: series of Polygons with the same index
+    """
+    parts = geometry.explode()
+    largest = parts[parts.area.groupby(level=0).idxmax()]
+    largest.index = largest.index.droplevel(-1)
+    return largest.reindex(geometry.index)
+
+
+def to_pygeos(geometry: gpd.GeoSeries):
+    """
+    Gets the pygeos array behind a geoseries, converting it if geopandas isn't using pygeos
+    :param geometry: series of geometries
+    :return: numpy array of pygeos geometries
     """
-    return max(geom, key=lambda a: a.area) if type(geom) == MultiPolygon else geom
+    return geometry.values.data if gpd.options.use_pygeos else pygeos.from_shapely(geometry.values)
 
 
-def create_wkt_element(geom, srid=DEFAULT_LAT_LONG_PROJ):
+def to_ewkb(geometry: gpd.GeoSeries, srid: int = DEFAULT_LAT_LONG_PROJ) -> pd.Series:
     """
-    Converts a geometry element to a string that is readable by PostGIS
-    :param geom: Geometry object
+    Encodes every geometry as hex EWKB in one vectorized call, which PostGIS reads directly from COPY
+    :param geometry: series of geometries
     :param srid: ID for a spatial reference system
-    :return: SQL compatible string
+    :return: series of hex strings
+    """
+    ewkb = pygeos.to_wkb(pygeos.set_srid(to_pygeos(geometry), srid), hex=True, include_srid=True)
+    return pd.Series(ewkb, index=geometry.index)
+
+
+def simplify_polygons(geometry: gpd.GeoSeries, tolerance: float) -> gpd.GeoSeries:
+    """
+    Simplifies shapes in the Connecticut projection so the tolerance is in meters. Borders are simplified once as
+    arcs between the points where neighbors meet and the shapes are rebuilt from the simplified arcs, so neighbors
+    keep sharing the same border without gaps or overlaps
+    :param geometry: series of Polygons
+    :param tolerance: largest distance in meters a simplified edge can move from the original
+    :return: simplified series of Polygons in the original projection
     """
-    return WKTElement(geom.wkt, srid=srid)
+    projected = geometry.to_crs(epsg=CT_EPSG_CODE).reset_index(drop=True)
+    # Noding every border together turns a border shared by two neighbors into one arc. Simplifying the arcs as one
+    # collection keeps their end points and stops them from crossing each other
+    arcs = linemerge(unary_union(list(projected.boundary))).simplify(tolerance, preserve_topology=True)
+    faces = gpd.GeoSeries(list(polygonize(unary_union(arcs))), crs=projected.crs)
+
+    # Each face goes to the shape it overlaps most, faces outside every shape (water between them) are dropped
+    face_idx, shape_idx = projected.sindex.query_bulk(faces, predicate='intersects')
+    overlap = faces.iloc[face_idx].reset_index(drop=True).intersection(
+        projected.iloc[shape_idx].reset_index(drop=True)).area
+    owners = pd.DataFrame({'face': face_idx, 'shape': shape_idx, 'overlap': overlap.values})
+    owners = owners.sort_values('overlap').drop_duplicates('face', keep='last')
+    owners = owners[owners['overlap'] > 0]
+    rebuilt = owners.groupby('shape')['face'].apply(lambda x: unary_union(list(faces.iloc[x.values])))
+
+    # Shapes smaller than the tolerance lose their border, they keep their own simplified outline
+    own_outlines = projected.simplify(tolerance, preserve_topology=True)
+    simplified = gpd.GeoSeries([rebuilt.get(i, x) for i, x in enumerate(own_outlines)], index=geometry.index,
+                               crs=projected.crs)
+    return get_largest_polygons(simplified.to_crs(geometry.crs))
 
 
 def write_to_sql(table_name: str, geo_df: gpd.GeoDataFrame, columns: list,
-                 engine: sqlalchemy.engine, srid: int = DEFAULT_LAT_LONG_PROJ, schema: str = DEFAULT_SCHEMA):
+                 engine: sqlalchemy.engine, srid: int = DEFAULT_LAT_LONG_PROJ, schema: str = DEFAULT_SCHEMA,
+                 key_columns: list = None, cluster: bool = False, simplified_tolerances: dict = None):
     """
     Writes the specified columns in the geodataframe to a DB table, if the table already exists
     this overwrites it. The projection of the resulting geography is specified by the SRID. This assumes
@@ -48,21 +100,49 @@ def write_to_sql(table_name: str, geo_df: gpd.GeoDataFrame, columns: list,
     :param srid: Spatial reference system     ## TODO
     # Check if CT spatial code works better here
     :param schema: DB Schema where table will be written
+    :param key_columns: columns to add btree indexes to, defaults to the geo ID
+    :param cluster: whether to cluster the table on its spatial index
+    :param simplified_tolerances: dictionary of extra geometry column to simplification tolerance in meters
     :return: None, writes to table
     """
-    # Convert to multi-polygon and stringify the geography column
-    geo_df[GEOMETRY_COL] = geo_df[GEOMETRY_COL].apply(convert_to_poly)
-    geo_df[GEOMETRY_COL] = geo_df[GEOMETRY_COL].apply(create_wkt_element)
+    key_columns = [FINAL_GEO_ID] if key_columns is None else key_columns
+    simplified_tolerances = SIMPLIFIED_TOLERANCES if simplified_tolerances is None else simplified_tolerances
+    # Keep the largest polygon of each shape and encode it as EWKB for COPY
+    load_df = pd.DataFrame(geo_df[columns])
+    polygons = get_largest_polygons(geo_df.geometry)
+    load_df[GEOMETRY_COL] = to_ewkb(polygons, srid=srid)
+
+    # Lighter versions of the shapes for map charts that don't need full TIGER resolution
+    full_vertices = pygeos.get_num_coordinates(to_pygeos(polygons)).sum()
+    for simplified_col, tolerance in simplified_tolerances.items():
+        simplified = simplify_polygons(polygons, tolerance)
+        load_df[simplified_col] = to_ewkb(simplified, srid=srid)
+        vertices = pygeos.get_num_coordinates(to_pygeos(simplified)).sum()
+        print(f"{simplified_col} ({tolerance}m) keeps {vertices} of {full_vertices} vertices")
 
     print(f"Loading {table_name}")
-    # Write to table specifying the geometry as a POLYGON with the given projection
-    geo_df[columns + [GEOMETRY_COL]].to_sql(table_name, engine, schema='uploaded_data', if_exists='replace', index=False,
-                                            dtype={GEOMETRY_COL: Geometry("POLYGON", srid=srid)})
+    # Rows are copied into a staging table that replaces the live one in a single transaction, so dashboards
+    # never see the table missing or half loaded
+    staging_table = f'{table_name}{STAGING_SUFFIX}'
+    with engine.connect() as conn:
+        with conn.begin():
+            conn.execute(f'DROP TABLE IF EXISTS {schema}.{staging_table}')
+            # Create the table specifying the geometry as a POLYGON with the given projection. Indexes are built
+            # after the swap so they're named for the live table and aren't updated row by row during the load
+            geometry_types = {x: Geometry("POLYGON", srid=srid, spatial_index=False)
+                              for x in [GEOMETRY_COL] + list(simplified_tolerances)}
+            load_df.head(0).to_sql(staging_table, conn, schema=schema, index=False, dtype=geometry_types)
+        copy_dataframe(load_df, table_name=staging_table, conn=conn, schema=schema, truncate=False)
+        with conn.begin():
+            conn.execute(f'DROP TABLE IF EXISTS {schema}.{table_name}')
+            conn.execute(f'ALTER TABLE {schema}.{staging_table} RENAME TO {table_name}')
+            index_table(conn, table_name, spatial_columns=[GEOMETRY_COL],
+                        key_columns=[x for x in key_columns if x in load_df.columns], cluster=cluster, schema=schema)
 
     print(f"Table {table_name} loaded")
 
 
-def load_level_table(geo_level, table_name, columns, engine, file_type=CARTO):
+def load_level_table(geo_level, table_name, columns, engine, file_type=CARTO, cluster=False):
     """
     Builds a dataframe with geojson and metadata and loads it directly to the database
     :param geo_level: level (TOWN, leg etc.)
@@ -70,6 +150,7 @@ def load_level_table(geo_level, table_name, columns, engine, file_type=CARTO):
     :param columns: Columns to keep from original census shapefile
     :param engine: DB engine
     :param file_type:
+    :param cluster: whether to cluster the table on its spatial index
     :return: None, loads table to db
     """
 
@@ -92,4 +173,4 @@ def load_level_table(geo_level, table_name, columns, engine, file_type=CARTO):
         geo_leg_key = FINAL_HOUSE_ID if geo_level == HOUSE else FINAL_SENATE_ID
         level_geo_df = level_geo_df.merge(legis_df, how='left', left_on=geo_leg_key, right_on=CURRENT_DISTRICT)
 
-    write_to_sql(table_name=table_name, geo_df=level_geo_df, engine=engine, columns=columns)
+    write_to_sql(table_name=table_name, geo_df=level_geo_df, engine=engine, columns=columns, cluster=cluster)
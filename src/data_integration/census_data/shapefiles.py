@@ -1,11 +1,30 @@
 import geopandas as gpd
 import os
+import json
+import hashlib
 import requests
+import concurrent.futures as futures
+from datetime import datetime
 
 CT_EPSG_CODE = 2775 # Projection for state of Connecticut, makes centroids more precise
 DEFAULT_LAT_LONG_PROJ = 4269 # Default lat/long projection for US
 DATA_FOLDER = 'data'
 
+# Processed layers are stored as GeoParquet next to the zip they were built from, named by a hash of the zip
+# so a new download is picked up. Bump the version when the processing in build_level_df changes
+PROCESSED_FOLDER = 'processed'
+PROCESSED_VERSION = '1'
+CENTROID_COL = 'centroid'
+
+# Downloads run at the same time and are streamed to disk in chunks. The ETag and Last-Modified headers of each
+# download are kept next to it so later downloads can ask the server whether the file changed
+DOWNLOAD_WORKERS = 4
+DOWNLOAD_CHUNK_BYTES = 1024 * 1024
+DOWNLOAD_TIMEOUT_SECONDS = 300
+DOWNLOAD_METADATA_SUFFIX = '.download.json'
+# Zips are hashed in pieces so large layers aren't read into memory at once
+HASH_CHUNK_BYTES = 1024 * 1024
+
 # Documentation surrounding census data and shapefiles
 # https://www2.census.gov/geo/tiger/Directory_Contents_ReadMe.pdf
 # https://www2.census.gov/geo/pdfs/maps-data/data/tiger/tgrshp2020pl/TGRSHP2020PL_TechDoc.pdf
@@ -68,69 +87,179 @@ REFERENCE_DICT = {TOWN: {TIGER: sub_county_full_tiger_file, CARTO: sub_county_ca
                   BLOCK: {TIGER: block_full_tiger_file}}
 
 
-def download_all_data():
+# Layers already loaded by this process, keyed by level, file type and source fingerprint
+_layer_memo = {}
+
+
+def download_all_data(workers: int = DOWNLOAD_WORKERS):
+    """
+    Downloads every layer in REFERENCE_DICT at the same time, skipping files the server reports as unchanged,
+    then processes each layer
+    :param workers: number of files downloaded at the same time
+    :return: None, saves files
+    """
+    layer_list = [(geo_level, file_type) for geo_level, file_type_dict in REFERENCE_DICT.items()
+                  for file_type in file_type_dict.keys()]
+    with futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        future_list = [executor.submit(get_geo_data_zip_file, url=REFERENCE_DICT[geo_level][file_type],
+                                       geo_type=geo_level, file_type=file_type, redownload=True)
+                       for geo_level, file_type in layer_list]
+        for future in futures.as_completed(future_list):
+            future.result()
 
-    for geo_level, file_type_dict in REFERENCE_DICT.items():
-        for file_type in file_type_dict.keys():
-            build_level_df(geo_level=geo_level, file_type=file_type, redownload=True)
+    for geo_level, file_type in layer_list:
+        build_level_df(geo_level=geo_level, file_type=file_type)
 
 
 def add_centroid(geo_df: gpd.GeoDataFrame,
                  new_epsg_code: int = CT_EPSG_CODE,
                  final_epsg_code: int = DEFAULT_LAT_LONG_PROJ) -> gpd.GeoDataFrame:
     """
-
-    :param geo_df:
-    :param new_epsg_code:
-    :return:
+    Adds the centroid of each shape and its lat/long. Centroids are found in the projected CRS so they're precise,
+    only the geometry column is projected there and the frame is only reprojected if it isn't already in the final CRS
+    :param geo_df: geodataframe of shapes
+    :param new_epsg_code: projection to find centroids in
+    :param final_epsg_code: projection of the returned shapes and centroids
+    :return: geodataframe with centroid, lat and long columns
     """
-    geo_df = geo_df.to_crs(epsg=new_epsg_code)
-    geo_df['centroid'] = geo_df.centroid
-    geo_df = geo_df.to_crs(epsg=final_epsg_code)
-    geo_df['centroid'] = geo_df['centroid'].to_crs(epsg=final_epsg_code)
-    geo_df['lat'] = geo_df['centroid'].y
-    geo_df['long'] = geo_df['centroid'].x
+    centroids = geo_df.geometry.to_crs(epsg=new_epsg_code).centroid.to_crs(epsg=final_epsg_code)
+    if geo_df.crs is None or geo_df.crs.to_epsg() != final_epsg_code:
+        geo_df = geo_df.to_crs(epsg=final_epsg_code)
+    geo_df[CENTROID_COL] = centroids
+    geo_df['lat'] = centroids.y
+    geo_df['long'] = centroids.x
     return geo_df
 
 
-def build_level_df(geo_level, file_type, redownload=False):
+def get_processed_file(zip_file_name: str) -> (str, str):
+    """
+    Finds where the processed version of a downloaded zip is stored
+    :param zip_file_name: path of the downloaded shapefile zip
+    :return: tuple of the source fingerprint and the GeoParquet path
+    """
+    hasher = hashlib.sha256(PROCESSED_VERSION.encode())
+    with open(zip_file_name, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_BYTES), b''):
+            hasher.update(chunk)
+    fingerprint = hasher.hexdigest()[:16]
+    zip_folder, zip_base_name = os.path.split(zip_file_name)
+    processed_name = zip_base_name.replace('.zip', f'.{fingerprint}.parquet')
+    return fingerprint, f'{zip_folder}/{PROCESSED_FOLDER}/{processed_name}'
+
+
+def remove_stale_layers(processed_file: str) -> None:
+    """
+    Deletes layers processed from earlier downloads of the same zip
+    :param processed_file: path of the current processed layer
+    :return: None, removes files
+    """
+    processed_folder, processed_name = os.path.split(processed_file)
+    stem = processed_name.split('.')[0]
+    for file_name in os.listdir(processed_folder):
+        if file_name != processed_name and file_name.split('.')[0] == stem and file_name.endswith('.parquet'):
+            os.remove(f'{processed_folder}/{file_name}')
+
 
+def build_level_df(geo_level, file_type, redownload=False, use_cache=True):
+    """
+    Loads a geographic level with centroids and renamed columns. The processed layer is kept in memory and as
+    GeoParquet, both are rebuilt when the downloaded zip changes
+    :param geo_level: level (TOWN, leg etc.)
+    :param file_type: Flavor of shapefile (TIGER, cartographic lines)
+    :param redownload: Whether to download the data regardless of whether it exists locally
+    :param use_cache: Whether to use processed layers, otherwise the zip is read and processed again
+    :return: geodataframe, a copy callers are free to change
+    """
     file_type_dict = REFERENCE_DICT[geo_level]
     url = file_type_dict[file_type]
 
     file_name = get_geo_data_zip_file(url=url, geo_type=geo_level, file_type=file_type, redownload=redownload)
-    df = gpd.read_file(f'zip://{file_name}')
-    df = add_centroid(geo_df=df)
-    df.rename(columns=RENAME_DICT, inplace=True)
-    return df
+    fingerprint, processed_file = get_processed_file(file_name)
+    memo_key = (geo_level, file_type, fingerprint)
+    if use_cache and memo_key in _layer_memo:
+        return _layer_memo[memo_key].copy()
+
+    if use_cache and os.path.exists(processed_file):
+        df = gpd.read_parquet(processed_file)
+    else:
+        df = gpd.read_file(f'zip://{file_name}')
+        df = add_centroid(geo_df=df)
+        df.rename(columns=RENAME_DICT, inplace=True)
+
+        # Write under a temporary name so a failed write doesn't leave a partial layer behind
+        os.makedirs(os.path.dirname(processed_file), exist_ok=True)
+        df.to_parquet(processed_file + '.tmp')
+        os.replace(processed_file + '.tmp', processed_file)
+        remove_stale_layers(processed_file)
+        print(f"Saved processed {geo_level} {file_type} layer to {processed_file}")
+
+    _layer_memo[memo_key] = df
+    return df.copy()
 
 
-def get_geo_data_zip_file(url: str, geo_type: str, file_type: str, redownload=False) -> [str]:
+def download_file(url: str, file_name: str, check_remote: bool = False) -> bool:
     """
-    Downloads and unzips files from URL if they don't already exist and returns a list of all the downloaded file names
+    Streams a file to disk. It's written to a .part file that's only renamed once the whole body has arrived,
+    so an interrupted download never replaces a good file
+    :param url: Url of the file
+    :param file_name: path to save it to
+    :param check_remote: Whether to ask the server if an existing file changed, otherwise existing files are kept
+    :return: True if the file was downloaded
+    """
+    metadata_file = file_name + DOWNLOAD_METADATA_SUFFIX
+    headers = {}
+    if os.path.exists(file_name):
+        if not check_remote:
+            return False
+        if os.path.exists(metadata_file):
+            with open(metadata_file) as f:
+                metadata = json.load(f)
+            if metadata.get('etag'):
+                headers['If-None-Match'] = metadata['etag']
+            if metadata.get('last_modified'):
+                headers['If-Modified-Since'] = metadata['last_modified']
+
+    with requests.get(url, headers=headers, stream=True, timeout=DOWNLOAD_TIMEOUT_SECONDS) as r:
+        if r.status_code == 304:
+            print(f"{file_name} is unchanged at {url}")
+            return False
+        r.raise_for_status()
+        print(f"Downloading data from {url}, saving to {file_name}")
+        part_file = file_name + '.part'
+        written = 0
+        with open(part_file, 'wb') as output_file:
+            for chunk in r.iter_content(chunk_size=DOWNLOAD_CHUNK_BYTES):
+                output_file.write(chunk)
+                written += len(chunk)
+        expected = r.headers.get('Content-Length')
+        if expected and int(expected) != written and not r.headers.get('Content-Encoding'):
+            os.remove(part_file)
+            raise Exception(f"Download of {url} stopped after {written} of {expected} bytes")
+        os.replace(part_file, file_name)
+
+        metadata = {'url': url, 'etag': r.headers.get('ETag'), 'last_modified': r.headers.get('Last-Modified'),
+                    'size': written, 'downloaded_at': datetime.now().isoformat(timespec='seconds')}
+    with open(metadata_file + '.tmp', 'w') as f:
+        json.dump(metadata, f, indent=2)
+    os.replace(metadata_file + '.tmp', metadata_file)
+    return True
+
+
+def get_geo_data_zip_file(url: str, geo_type: str, file_type: str, redownload=False) -> str:
+    """
+    Downloads the zip file from URL if it doesn't already exist and returns its file name
     :param url: Url where zip file lives
     :param geo_type: Level of geographic detail (Towns, leg. districts)
     :param file_type: Flavor of shapefile to download (TIGER, cartographic lines)
-    :param redownload: Whether to download the data regardless of whether it exists locally
-    :return: list of filenames in the pulled directory
+    :param redownload: Whether to check for a newer version of the file even if it exists locally
+    :return: path of the downloaded zip file
     """
 
     file_dir = os.path.dirname(os.path.realpath(__file__))
-    geo_folder_name = f"{file_dir}/{DATA_FOLDER}/{geo_type.replace(' ', '_')}"
-    if not os.path.exists(geo_folder_name):
-        os.mkdir(geo_folder_name)
-    full_folder_name = f"{geo_folder_name}/{file_type}/"
-    if not os.path.exists(full_folder_name):
-        os.mkdir(full_folder_name)
+    full_folder_name = f"{file_dir}/{DATA_FOLDER}/{geo_type.replace(' ', '_')}/{file_type}/"
+    os.makedirs(full_folder_name, exist_ok=True)
     file_name = (full_folder_name + os.path.basename(url))
-
-    if not os.path.exists(file_name) or redownload:
-        request = requests.get(url)
-        print(f"Downloading data from {url}, saving to {file_name}")
-        with open(file_name, 'wb') as output_file:
-            output_file.write(request.content)
-
-    # Check if the folder has already been downloaded or if it should be redownloaded
+    download_file(url, file_name, check_remote=redownload)
     return file_name
 
 
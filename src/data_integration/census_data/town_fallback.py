@@ -0,0 +1,63 @@
+import numpy as np
+import pandas as pd
+from geocode_cache import normalize_text
+from shapefiles import FINAL_NAME, FINAL_GEO_ID
+
+UNDEFINED_TOWN = 'County subdivisions not defined'
+
+# Prefixes and suffixes families write that aren't part of the Census town name
+TOWN_NAME_PATTERN = r'^(?:town of |city of )?(.*?)(?: town| city| ct)?$'
+
+GEOCODED_TIER = 'geocoded'
+TOWN_NAME_TIER = 'town name'
+ZIP_CODE_TIER = 'zip code'
+UNRESOLVED_TIER = 'unresolved'
+
+
+def normalize_town(towns: pd.Series) -> pd.Series:
+    return normalize_text(towns).str.extract(TOWN_NAME_PATTERN, expand=False)
+
+
+def normalize_zip(zip_codes: pd.Series) -> pd.Series:
+    return zip_codes.fillna('').astype(str).str.extract(r'(\d{5})', expand=False)
+
+
+def resolve_missing_towns(town_ids: pd.Series, input_towns: pd.Series, zip_codes: pd.Series,
+                          town_df: pd.DataFrame) -> np.ndarray:
+    """
+    Fills in towns for children the geocoder couldn't place. The town they entered is matched to a Census town name
+    first, then the zip code is given the town most geocoded children with that zip code live in
+    :param town_ids: town geo IDs found by geocoding, null where it failed
+    :param input_towns: towns entered for each child
+    :param zip_codes: zip codes entered for each child
+    :param town_df: Census towns with name and geo ID columns
+    :return: array of town geo IDs with as many gaps filled as possible, aligned with town_ids
+    """
+    # Positions are used throughout since concatenated batches can repeat index values
+    town_ids, input_towns, zip_codes = [x.reset_index(drop=True) for x in [town_ids, input_towns, zip_codes]]
+    town_df = town_df[town_df[FINAL_NAME] != UNDEFINED_TOWN]
+    town_lookup = pd.Series(town_df[FINAL_GEO_ID].values, index=normalize_town(town_df[FINAL_NAME]))
+    town_lookup = town_lookup[~town_lookup.index.duplicated()]
+
+    resolved = town_ids.copy()
+    tiers = pd.Series(GEOCODED_TIER, index=resolved.index)
+    tiers[resolved.isna()] = UNRESOLVED_TIER
+
+    missing = resolved.isna()
+    resolved[missing] = normalize_town(input_towns[missing]).map(town_lookup)
+    tiers[missing & resolved.notna()] = TOWN_NAME_TIER
+
+    # Zip codes can cross town lines, so each one takes the town most of its geocoded children are in
+    zips = normalize_zip(zip_codes)
+    geocoded = tiers == GEOCODED_TIER
+    zip_counts = pd.DataFrame({'zip': zips[geocoded], 'town': resolved[geocoded]}).dropna() \
+        .groupby(['zip', 'town']).size().rename('children').reset_index()
+    zip_lookup = zip_counts.sort_values('children', ascending=False).drop_duplicates('zip').set_index('zip')['town']
+    missing = resolved.isna()
+    resolved[missing] = zips[missing].map(zip_lookup)
+    tiers[missing & resolved.notna()] = ZIP_CODE_TIER
+
+    counts = tiers.value_counts()
+    print("Towns found by " + ', '.join(f"{tier}: {counts.get(tier, 0)}" for tier in
+                                        [GEOCODED_TIER, TOWN_NAME_TIER, ZIP_CODE_TIER, UNRESOLVED_TIER]))
+    return resolved.where(resolved.notna(), None).to_numpy(dtype=object)
@@ -0,0 +1,233 @@
+import os
+import gzip
+import json
+import math
+import sqlite3
+from contextlib import closing
+import hashlib
+import pandas as pd
+import geopandas as gpd
+import mapbox_vector_tile
+from shapely.geometry import box
+from shapefiles import build_level_df, get_geo_data_zip_file, get_processed_file, REFERENCE_DICT, TOWN, SENATE, \
+    HOUSE, BLOCK, TIGER, CARTO, FINAL_NAME, FINAL_GEO_ID, FINAL_TOWN_ID, FINAL_SENATE_ID, FINAL_HOUSE_ID, \
+    FINAL_TRACT_ID, FINAL_BLOCK_ID, DATA_FOLDER
+
+FILE_DIR = os.path.dirname(os.path.realpath(__file__))
+TILE_FOLDER = f'{FILE_DIR}/{DATA_FOLDER}/tiles'
+TILE_FILE = f'{TILE_FOLDER}/ct_geography.mbtiles'
+# Bump the version when the tile contents change so existing tile files are rebuilt
+TILE_VERSION = '1'
+
+# Web Mercator, the projection map tiles are cut in
+WEB_MERCATOR = 3857
+WEB_MERCATOR_BOUND = 20037508.342789244
+LAT_LONG = 4326
+
+MIN_ZOOM = 6
+MAX_ZOOM = 12
+# Coordinates per tile side and the margin kept around each tile so stroked borders don't clip at tile edges
+TILE_EXTENT = 4096
+TILE_BUFFER = 64
+
+# Tile layer name, shapefile flavor, first zoom it's drawn at and the attributes needed to join it to other tables.
+# Legislative districts and towns match the geography tables, block groups only exist as TIGER files
+TILE_LAYERS = {TOWN: {'name': 'towns', 'file_type': CARTO, 'min_zoom': MIN_ZOOM,
+                      'columns': [FINAL_GEO_ID, FINAL_TOWN_ID, FINAL_NAME]},
+               SENATE: {'name': 'senate_districts', 'file_type': CARTO, 'min_zoom': MIN_ZOOM,
+                        'columns': [FINAL_GEO_ID, FINAL_SENATE_ID]},
+               HOUSE: {'name': 'house_districts', 'file_type': CARTO, 'min_zoom': MIN_ZOOM,
+                       'columns': [FINAL_GEO_ID, FINAL_HOUSE_ID]},
+               BLOCK: {'name': 'block_groups', 'file_type': TIGER, 'min_zoom': 9,
+                       'columns': [FINAL_GEO_ID, FINAL_TRACT_ID, FINAL_BLOCK_ID]}}
+
+
+def get_tile_bounds(zoom: int, x: int, y: int) -> (float, float, float, float):
+    """
+    Finds the Web Mercator bounds of a tile, tiles are numbered from the top left corner
+    :param zoom: zoom level
+    :param x: tile column
+    :param y: tile row
+    :return: tuple of min x, min y, max x, max y in meters
+    """
+    tile_size = 2 * WEB_MERCATOR_BOUND / 2 ** zoom
+    min_x = -WEB_MERCATOR_BOUND + x * tile_size
+    max_y = WEB_MERCATOR_BOUND - y * tile_size
+    return min_x, max_y - tile_size, min_x + tile_size, max_y
+
+
+def get_tile_range(zoom: int, bounds: (float, float, float, float)) -> (range, range):
+    """
+    Finds the tiles covering a bounding box
+    :param zoom: zoom level
+    :param bounds: tuple of min x, min y, max x, max y in Web Mercator meters
+    :return: tuple of the tile column and row ranges
+    """
+    tile_size = 2 * WEB_MERCATOR_BOUND / 2 ** zoom
+    min_x, min_y, max_x, max_y = bounds
+    x_range = range(math.floor((min_x + WEB_MERCATOR_BOUND) / tile_size),
+                    math.floor((max_x + WEB_MERCATOR_BOUND) / tile_size) + 1)
+    y_range = range(math.floor((WEB_MERCATOR_BOUND - max_y) / tile_size),
+                    math.floor((WEB_MERCATOR_BOUND - min_y) / tile_size) + 1)
+    return x_range, y_range
+
+
+def get_source_fingerprint() -> str:
+    """
+    Names the tile build by the shapefiles it's cut from, so downloading any of them again rebuilds the tiles
+    :return: hex digest
+    """
+    hasher = hashlib.sha256(TILE_VERSION.encode())
+    for geo_level, layer in TILE_LAYERS.items():
+        zip_file_name = get_geo_data_zip_file(url=REFERENCE_DICT[geo_level][layer['file_type']], geo_type=geo_level,
+                                              file_type=layer['file_type'])
+        hasher.update(get_processed_file(zip_file_name)[0].encode())
+    return hasher.hexdigest()[:16]
+
+
+def read_tile_layers() -> dict:
+    """
+    Loads every tile layer in Web Mercator with only the attributes tiles carry
+    :return: dictionary of geographic level to geodataframe
+    """
+    layer_dfs = {}
+    for geo_level, layer in TILE_LAYERS.items():
+        level_df = build_level_df(geo_level=geo_level, file_type=layer['file_type'])
+        level_df = gpd.GeoDataFrame(level_df[layer['columns']], geometry=level_df.geometry, crs=level_df.crs)
+        layer_dfs[geo_level] = level_df.to_crs(epsg=WEB_MERCATOR).reset_index(drop=True)
+    return layer_dfs
+
+
+def build_features(level_df: gpd.GeoDataFrame, columns: list) -> [dict]:
+    """
+    Turns the shapes of one layer in a tile into features for the encoder
+    :param level_df: geodataframe of clipped shapes
+    :param columns: attribute columns
+    :return: list of features with geometry and properties
+    """
+    properties = level_df[columns].astype(object).where(level_df[columns].notna(), None).to_dict('records')
+    return [{'geometry': geometry, 'properties': {k: v for k, v in props.items() if v is not None}}
+            for geometry, props in zip(level_df.geometry, properties)]
+
+
+def encode_zoom(layer_dfs: dict, zoom: int):
+    """
+    Cuts every tile of one zoom level. Shapes are simplified to the size of a tile coordinate first so tiles at
+    low zooms don't carry detail that can't be drawn
+    :param layer_dfs: dictionary of geographic level to geodataframe in Web Mercator
+    :param zoom: zoom level
+    :return: generator of tuples of tile column, row and gzipped tile
+    """
+    tile_size = 2 * WEB_MERCATOR_BOUND / 2 ** zoom
+    tolerance = tile_size / TILE_EXTENT
+    zoom_dfs = {}
+    for geo_level, level_df in layer_dfs.items():
+        if zoom >= TILE_LAYERS[geo_level]['min_zoom']:
+            simplified = level_df.geometry.simplify(tolerance, preserve_topology=True)
+            zoom_dfs[geo_level] = level_df.set_geometry(simplified)
+    if not zoom_dfs:
+        return
+
+    bounds = pd.concat([x.bounds for x in zoom_dfs.values()])
+    x_range, y_range = get_tile_range(zoom, (bounds['minx'].min(), bounds['miny'].min(),
+                                             bounds['maxx'].max(), bounds['maxy'].max()))
+    buffer = tile_size * TILE_BUFFER / TILE_EXTENT
+    for x in x_range:
+        for y in y_range:
+            tile_bounds = get_tile_bounds(zoom, x, y)
+            tile_box = box(*tile_bounds).buffer(buffer, join_style=2)
+            tile_layers = []
+            for geo_level, level_df in zoom_dfs.items():
+                candidates = level_df.sindex.query(tile_box, predicate='intersects')
+                if len(candidates) == 0:
+                    continue
+                clipped_df = level_df.iloc[candidates]
+                clipped_df = clipped_df.set_geometry(clipped_df.geometry.intersection(tile_box))
+                clipped_df = clipped_df[~clipped_df.geometry.is_empty]
+                tile_layers.append({'name': TILE_LAYERS[geo_level]['name'],
+                                    'features': build_features(clipped_df, TILE_LAYERS[geo_level]['columns'])})
+            if tile_layers:
+                tile = mapbox_vector_tile.encode(tile_layers, quantize_bounds=tile_bounds, extents=TILE_EXTENT)
+                yield x, y, gzip.compress(tile)
+
+
+def get_metadata(layer_dfs: dict, min_zoom: int, max_zoom: int, fingerprint: str) -> dict:
+    """
+    Builds the MBTiles metadata, including the vector layer list map clients use to style the tiles
+    :param layer_dfs: dictionary of geographic level to geodataframe in Web Mercator
+    :param min_zoom: first zoom level in the file
+    :param max_zoom: last zoom level in the file
+    :param fingerprint: fingerprint of the source shapefiles
+    :return: dictionary of metadata name to value
+    """
+    bounds = gpd.GeoSeries(box(*layer_dfs[TOWN].total_bounds), crs=WEB_MERCATOR).to_crs(epsg=LAT_LONG).total_bounds
+    vector_layers = [{'id': layer['name'], 'fields': {x: 'String' for x in layer['columns']},
+                      'minzoom': max(layer['min_zoom'], min_zoom), 'maxzoom': max_zoom}
+                     for layer in TILE_LAYERS.values()]
+    return {'name': 'Connecticut geography', 'format': 'pbf', 'type': 'overlay',
+            'minzoom': str(min_zoom), 'maxzoom': str(max_zoom),
+            'bounds': ','.join(f'{x:.6f}' for x in bounds),
+            'center': f'{(bounds[0] + bounds[2]) / 2:.6f},{(bounds[1] + bounds[3]) / 2:.6f},{min_zoom}',
+            'json': json.dumps({'vector_layers': vector_layers}),
+            'source_fingerprint': fingerprint}
+
+
+def read_fingerprint(tile_file: str):
+    """
+    Reads the source fingerprint recorded in an existing tile file
+    :param tile_file: path of the MBTiles file
+    :return: fingerprint, or None if the file doesn't exist or has none
+    """
+    if not os.path.exists(tile_file):
+        return None
+    with closing(sqlite3.connect(tile_file)) as conn:
+        try:
+            row = conn.execute("select value from metadata where name = 'source_fingerprint'").fetchone()
+        except sqlite3.DatabaseError:
+            return None
+    return row[0] if row else None
+
+
+def build_vector_tiles(tile_file: str = TILE_FILE, min_zoom: int = MIN_ZOOM, max_zoom: int = MAX_ZOOM,
+                       rebuild: bool = False) -> str:
+    """
+    Writes towns, legislative districts and block groups as Mapbox Vector Tiles to an MBTiles file. The file is
+    only rebuilt when the shapefiles change, and is written under a temporary name so map servers keep reading
+    the old tiles until the new ones are complete
+    :param tile_file: path of the MBTiles file
+    :param min_zoom: first zoom level to cut
+    :param max_zoom: last zoom level to cut
+    :param rebuild: Whether to build the tiles regardless
+    :return: path of the MBTiles file
+    """
+    fingerprint = get_source_fingerprint()
+    if not rebuild and read_fingerprint(tile_file) == fingerprint:
+        print(f"Tiles in {tile_file} are up to date")
+        return tile_file
+
+    layer_dfs = read_tile_layers()
+    os.makedirs(os.path.dirname(tile_file), exist_ok=True)
+    tmp_file = tile_file + '.tmp'
+    if os.path.exists(tmp_file):
+        os.remove(tmp_file)
+
+    with closing(sqlite3.connect(tmp_file)) as conn:
+        conn.execute('create table metadata (name text, value text)')
+        conn.execute('create table tiles (zoom_level integer, tile_column integer, tile_row integer, tile_data blob)')
+        conn.execute('create unique index tile_index on tiles (zoom_level, tile_column, tile_row)')
+        for zoom in range(min_zoom, max_zoom + 1):
+            # MBTiles rows count from the bottom of the map
+            rows = [(zoom, x, 2 ** zoom - 1 - y, tile) for x, y, tile in encode_zoom(layer_dfs, zoom)]
+            conn.executemany('insert into tiles values (?, ?, ?, ?)', rows)
+            conn.commit()
+            print(f"Wrote {len(rows)} tiles for zoom {zoom}")
+        conn.executemany('insert into metadata values (?, ?)',
+                         get_metadata(layer_dfs, min_zoom, max_zoom, fingerprint).items())
+        conn.commit()
+    os.replace(tmp_file, tile_file)
+    print(f"Saved vector tiles to {tile_file}")
+    return tile_file
+
+
+if __name__ == '__main__':
+    build_vector_tiles()
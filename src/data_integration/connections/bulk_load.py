@@ -0,0 +1,148 @@
+import io
+import pandas as pd
+import sqlalchemy
+from typing import Iterable, Union
+
+DEFAULT_SCHEMA = 'uploaded_data'
+# Suffix of the table rows are loaded into before they replace a table's rows
+STAGING_SUFFIX = '_staging'
+
+# Rows serialized per COPY statement, keeps the in memory buffer small for large tables
+COPY_CHUNK_ROWS = 50000
+
+# Postgres types that can't parse pandas' float formatting of integers with missing values (e.g. 3.0)
+INTEGER_TYPES = ['smallint', 'integer', 'bigint', 'boolean']
+
+
+def get_table_columns(conn: sqlalchemy.engine.Connection, table_name: str, schema: str = DEFAULT_SCHEMA) -> dict:
+    """
+    Looks up the columns of an existing table
+    :param conn: SQLAlchemy connection to the Postgres database
+    :param table_name: name of the table
+    :param schema: schema of the table
+    :return: ordered dictionary of column name to Postgres data type, empty if the table doesn't exist
+    """
+    sql = sqlalchemy.text("""select column_name, data_type
+                             from information_schema.columns
+                             where table_schema = :schema and table_name = :table_name
+                             order by ordinal_position""")
+    rows = conn.execute(sql, schema=schema, table_name=table_name).fetchall()
+    return {row[0]: row[1] for row in rows}
+
+
+def iterate_chunks(data: Union[pd.DataFrame, Iterable[pd.DataFrame]], chunk_rows: int = COPY_CHUNK_ROWS):
+    """
+    Yields a dataframe, or each dataframe of an iterable, in slices of at most chunk_rows
+    :param data: dataframe or iterable of dataframes
+    :param chunk_rows: maximum rows per slice
+    :return: generator of dataframes
+    """
+    frames = [data] if isinstance(data, pd.DataFrame) else data
+    for frame in frames:
+        for start in range(0, frame.shape[0], chunk_rows):
+            yield frame.iloc[start:start + chunk_rows]
+
+
+def prepare_chunk(chunk: pd.DataFrame, column_types: dict, table_name: str = None) -> pd.DataFrame:
+    """
+    Orders columns to match the table and casts floats headed for integer or boolean columns to nullable ints.
+    Every column of the chunk has to exist in the table, so a renamed column fails the load instead of
+    leaving the table's column empty
+    :param chunk: dataframe to load
+    :param column_types: dictionary of column name to Postgres data type for the target table
+    :param table_name: name of the target table, used in the error message
+    :return: dataframe with the table's columns in table order
+    """
+    missing = [str(x) for x in chunk.columns if x not in column_types]
+    if missing:
+        raise Exception(f"Columns {','.join(missing)} are not in table {table_name}, "
+                        f"its columns are {','.join(column_types)}")
+    columns = [x for x in column_types if x in chunk.columns]
+    chunk = chunk[columns].copy()
+    for col in columns:
+        if column_types[col] in INTEGER_TYPES and pd.api.types.is_float_dtype(chunk[col]):
+            chunk[col] = chunk[col].round().astype('Int64')
+    return chunk
+
+
+def append_chunks(data: Union[pd.DataFrame, Iterable[pd.DataFrame]], table_name: str,
+                  conn: sqlalchemy.engine.Connection, schema: str = DEFAULT_SCHEMA) -> int:
+    """
+    Streams a dataframe, or an iterable of dataframe chunks, onto the end of a table with COPY FROM STDIN in one
+    transaction. Tables that don't exist yet are created from the columns of the first chunk. COPY only blocks
+    other writers, readers keep seeing the rows committed before it
+    :param data: dataframe or iterable of dataframes to load
+    :param table_name: name of the target table
+    :param conn: SQLAlchemy connection to the Postgres database
+    :param schema: schema of the target table
+    :return: number of rows loaded
+    """
+    total_rows = 0
+    with conn.begin():
+        column_types = get_table_columns(conn, table_name, schema)
+        cursor = conn.connection.cursor()
+        for chunk in iterate_chunks(data):
+            if not column_types:
+                print(f"Creating {schema}.{table_name}")
+                chunk.head(0).to_sql(table_name, conn, schema=schema, index=False)
+                column_types = get_table_columns(conn, table_name, schema)
+            chunk = prepare_chunk(chunk, column_types, table_name=f'{schema}.{table_name}')
+
+            buffer = io.StringIO()
+            chunk.to_csv(buffer, index=False, header=False)
+            buffer.seek(0)
+            column_list = ', '.join(f'"{x}"' for x in chunk.columns)
+            cursor.copy_expert(f'COPY {schema}.{table_name} ({column_list}) FROM STDIN WITH (FORMAT csv)', buffer)
+            total_rows += chunk.shape[0]
+        cursor.close()
+    return total_rows
+
+
+def copy_dataframe(data: Union[pd.DataFrame, Iterable[pd.DataFrame]], table_name: str,
+                   conn: sqlalchemy.engine.Connection, schema: str = DEFAULT_SCHEMA, truncate: bool = True) -> int:
+    """
+    Streams a dataframe, or an iterable of dataframe chunks, into a Postgres table with COPY FROM STDIN.
+    To replace the rows, chunks are copied into an unindexed staging table while they arrive, which can take as
+    long as the stage producing them. The table is only locked for the short transaction at the end that truncates
+    it and inserts the staged rows, readers are blocked during that step only and then see all of the new rows.
+    Indexes, defaults and permissions of the table are kept. Tables that don't exist yet are created from the
+    columns of the first chunk. The table is analyzed at the end
+    :param data: dataframe or iterable of dataframes to load
+    :param table_name: name of the target table
+    :param conn: SQLAlchemy connection to the Postgres database
+    :param schema: schema of the target table
+    :param truncate: whether to replace existing rows, otherwise chunks are appended straight to the table
+    :return: number of rows loaded
+    """
+    if not truncate:
+        total_rows = append_chunks(data, table_name, conn, schema)
+        with conn.begin():
+            conn.execute(f'ANALYZE {schema}.{table_name}')
+        print(f"Loaded {total_rows} rows into {schema}.{table_name}")
+        return total_rows
+
+    # Staging tables left behind by a failed load are replaced
+    staging_table = f'{table_name}{STAGING_SUFFIX}'
+    with conn.begin():
+        conn.execute(f'DROP TABLE IF EXISTS {schema}.{staging_table}')
+        column_types = get_table_columns(conn, table_name, schema)
+        if column_types:
+            conn.execute(f'CREATE TABLE {schema}.{staging_table} (LIKE {schema}.{table_name} INCLUDING DEFAULTS)')
+
+    total_rows = append_chunks(data, staging_table, conn, schema)
+
+    with conn.begin():
+        if column_types:
+            column_list = ', '.join(f'"{x}"' for x in column_types)
+            conn.execute(f'TRUNCATE TABLE {schema}.{table_name}')
+            conn.execute(f'INSERT INTO {schema}.{table_name} ({column_list}) '
+                         f'SELECT {column_list} FROM {schema}.{staging_table}')
+            conn.execute(f'DROP TABLE {schema}.{staging_table}')
+        elif get_table_columns(conn, staging_table, schema):
+            conn.execute(f'ALTER TABLE {schema}.{staging_table} RENAME TO {table_name}')
+        if column_types or total_rows:
+            # Planner statistics are refreshed with the rows so the first queries after a load don't wait on autovacuum
+            conn.execute(f'ANALYZE {schema}.{table_name}')
+
+    print(f"Loaded {total_rows} rows into {schema}.{table_name}")
+    return total_rows
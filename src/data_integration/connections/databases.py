@@ -1,6 +1,8 @@
 import os
+import threading
 import configparser
 import sqlalchemy
+from contextlib import contextmanager
 
 CONFIG_FILE = os.path.dirname(os.path.realpath(__file__)) + '/config.ini'
 
@@ -17,18 +19,21 @@ SQL_SERVER = 'sql server'
 VALID_DB_TYPES = [POSTGRES, SQL_SERVER]
 
 
-def get_db_connection(section: str, config_file: str = CONFIG_FILE) -> sqlalchemy.engine.base.Connection:
+# Engines are created once per process and config section so every stage checks warm connections out of the
+# same pool instead of logging in again. Keyed by process ID since pooled connections can't cross a fork
+_ENGINES = {}
+_ENGINE_LOCK = threading.Lock()
+POOL_SIZE = 5
+MAX_OVERFLOW = 5
+POOL_RECYCLE_SECONDS = 1800
+
+
+def get_connection_string(db_dict: configparser.SectionProxy) -> str:
     """
-    Reads a configuration file, connects to the specified database and returns sqlalchemy engine
-    :param section: section of configuration file that has DB creds
-    :param config_file: path to configuration file
-    :return engine: SQLAlchemy connection object
+    Builds the SQLAlchemy connection string from a section of the configuration file
+    :param db_dict: section of configuration file that has DB creds
+    :return: connection string
     """
-    config = configparser.ConfigParser()
-    config.read(config_file)
-
-    # Get credentials from config file
-    db_dict = config[section]
     host = db_dict[HOST_KEY]
     user_name = db_dict[USER_KEY]
     password = db_dict[PASSWORD_KEY]
@@ -43,7 +48,74 @@ def get_db_connection(section: str, config_file: str = CONFIG_FILE) -> sqlalchem
         conn_string = f'postgresql+psycopg2://{user_name}:{password}@{host}:{port}/{db_name}'
     elif db_type == SQL_SERVER:
         conn_string = f"mssql+pyodbc://{user_name}:{password}@{host},{port}/{db_name}?driver=ODBC+Driver+17+for+SQL+Server&Mars_Connection=Yes"
-    # Create and return DB connection
-    engine = sqlalchemy.create_engine(conn_string)
-    conn = engine.connect()
+    return conn_string
+
+
+def get_engine(section: str, config_file: str = CONFIG_FILE) -> sqlalchemy.engine.base.Engine:
+    """
+    Returns the pooled engine for a configuration section, creating it on first use. Connections are
+    pinged before they're handed out so a stage never gets one the server already closed
+    :param section: section of configuration file that has DB creds
+    :param config_file: path to configuration file
+    :return engine: SQLAlchemy engine
+    """
+    key = (os.getpid(), config_file, section)
+    with _ENGINE_LOCK:
+        if key not in _ENGINES:
+            config = configparser.ConfigParser()
+            config.read(config_file)
+            db_dict = config[section]
+            engine_kwargs = {'pool_pre_ping': True,
+                             'pool_size': POOL_SIZE,
+                             'max_overflow': MAX_OVERFLOW,
+                             'pool_recycle': POOL_RECYCLE_SECONDS}
+
+            # Sends parameter arrays in one round trip for executemany inserts
+            if db_dict[DB_TYPE_KEY] == SQL_SERVER:
+                engine_kwargs['fast_executemany'] = True
+            _ENGINES[key] = sqlalchemy.create_engine(get_connection_string(db_dict), **engine_kwargs)
+        return _ENGINES[key]
+
+
+def get_db_connection(section: str, config_file: str = CONFIG_FILE,
+                      stream_results: bool = False) -> sqlalchemy.engine.base.Connection:
+    """
+    Reads a configuration file, connects to the specified database and returns a connection from the pooled engine.
+    The caller should close the connection to return it to the pool, db_connection does this automatically
+    :param section: section of configuration file that has DB creds
+    :param config_file: path to configuration file
+    :param stream_results: fetch rows as they're read instead of buffering the whole result. Postgres uses a
+    server side cursor, pyodbc already fetches SQL Server rows from the server as they're consumed
+    :return conn: SQLAlchemy connection object
+    """
+    conn = get_engine(section=section, config_file=config_file).connect()
+    if stream_results:
+        conn = conn.execution_options(stream_results=True)
     return conn
+
+
+@contextmanager
+def db_connection(section: str, config_file: str = CONFIG_FILE, stream_results: bool = False):
+    """
+    Context manager version of get_db_connection that returns the connection to the pool when done
+    :param section: section of configuration file that has DB creds
+    :param config_file: path to configuration file
+    :param stream_results: see get_db_connection
+    :return conn: SQLAlchemy connection object
+    """
+    conn = get_db_connection(section=section, config_file=config_file, stream_results=stream_results)
+    try:
+        yield conn
+    finally:
+        conn.close()
+
+
+def dispose_engines() -> None:
+    """
+    Closes every pooled connection in this process
+    :return: None
+    """
+    with _ENGINE_LOCK:
+        for engine in _ENGINES.values():
+            engine.dispose()
+        _ENGINES.clear()
@@ -0,0 +1,106 @@
+import pandas as pd
+import sqlalchemy
+from data_integration.connections.bulk_load import DEFAULT_SCHEMA
+
+# Index access methods
+GIST = 'gist'
+BTREE = 'btree'
+VALID_METHODS = [GIST, BTREE]
+
+
+def get_index_name(table_name: str, column: str) -> str:
+    """
+    Names indexes the same way GeoAlchemy2 does so indexes created by either are recognized
+    :param table_name: name of the table
+    :param column: indexed column
+    :return: index name
+    """
+    return f'idx_{table_name}_{column}'
+
+
+def create_index(conn: sqlalchemy.engine.Connection, table_name: str, column: str, method: str = BTREE,
+                 schema: str = DEFAULT_SCHEMA) -> str:
+    """
+    Creates an index on one column if it doesn't exist yet
+    :param conn: SQLAlchemy connection to the Postgres database
+    :param table_name: name of the table
+    :param column: column to index
+    :param method: GIST for geometries, BTREE for keys
+    :param schema: schema of the table
+    :return: name of the index
+    """
+    if method not in VALID_METHODS:
+        raise Exception(f"{method} is not a valid index method, only {','.join(VALID_METHODS)} are allowed.")
+    index_name = get_index_name(table_name, column)
+    conn.execute(f'CREATE INDEX IF NOT EXISTS {index_name} ON {schema}.{table_name} USING {method} ("{column}")')
+    return index_name
+
+
+def index_table(conn: sqlalchemy.engine.Connection, table_name: str, spatial_columns: list = None,
+                key_columns: list = None, cluster: bool = False, schema: str = DEFAULT_SCHEMA) -> [str]:
+    """
+    Adds GIST indexes to geometry columns and btree indexes to join keys, then refreshes the planner statistics.
+    Clustering rewrites the table in the order of its first spatial index so shapes that are near each other are
+    read from the same pages, it locks the table while it runs
+    :param conn: SQLAlchemy connection to the Postgres database
+    :param table_name: name of the table
+    :param spatial_columns: geometry columns
+    :param key_columns: columns used in joins and filters
+    :param cluster: whether to cluster the table on its first spatial index
+    :param schema: schema of the table
+    :return: names of the table's indexes
+    """
+    spatial_columns = spatial_columns or []
+    key_columns = key_columns or []
+    with conn.begin():
+        index_names = [create_index(conn, table_name, x, method=GIST, schema=schema) for x in spatial_columns]
+        index_names += [create_index(conn, table_name, x, method=BTREE, schema=schema) for x in key_columns]
+        if cluster and spatial_columns:
+            print(f"Clustering {schema}.{table_name} on {index_names[0]}")
+            conn.execute(f'CLUSTER {schema}.{table_name} USING {index_names[0]}')
+        conn.execute(f'ANALYZE {schema}.{table_name}')
+    return index_names
+
+
+def get_index_report(conn: sqlalchemy.engine.Connection, schema: str = DEFAULT_SCHEMA) -> pd.DataFrame:
+    """
+    Lists every table in the schema with its indexes, their size and how often they've been scanned. Tables
+    without indexes are listed with a null index so they stand out
+    :param conn: SQLAlchemy connection to the Postgres database
+    :param schema: schema to report on
+    :return: dataframe with one row per index
+    """
+    sql = sqlalchemy.text("""select t.relname as table_name,
+                                    i.relname as index_name,
+                                    am.amname as method,
+                                    pg_get_indexdef(x.indexrelid) as definition,
+                                    pg_size_pretty(pg_relation_size(x.indexrelid)) as index_size,
+                                    s.idx_scan as scans,
+                                    t.reltuples::bigint as estimated_rows,
+                                    st.last_analyze,
+                                    st.last_autoanalyze
+                             from pg_class t
+                             join pg_namespace n on n.oid = t.relnamespace
+                             left join pg_index x on x.indrelid = t.oid
+                             left join pg_class i on i.oid = x.indexrelid
+                             left join pg_am am on am.oid = i.relam
+                             left join pg_stat_user_indexes s on s.indexrelid = x.indexrelid
+                             left join pg_stat_user_tables st on st.relid = t.oid
+                             where n.nspname = :schema and t.relkind = 'r'
+                             order by t.relname, i.relname""")
+    return pd.read_sql(sql, conn, params={'schema': schema})
+
+
+def print_index_report(conn: sqlalchemy.engine.Connection, schema: str = DEFAULT_SCHEMA) -> None:
+    """
+    Prints the index report for a schema
+    :param conn: SQLAlchemy connection to the Postgres database
+    :param schema: schema to report on
+    :return: None, prints report
+    """
+    report_df = get_index_report(conn, schema)
+    missing = report_df.loc[report_df['index_name'].isna(), 'table_name'].tolist()
+    with pd.option_context('display.max_rows', None, 'display.max_columns', None, 'display.width', 200):
+        print(report_df.drop(columns=['definition']).to_string(index=False))
+    if missing:
+        print(f"Tables in {schema} without indexes: {', '.join(missing)}")
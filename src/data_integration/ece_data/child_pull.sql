@@ -64,7 +64,8 @@ select
     inner join dbo.funding_space
         as fs on f.fundingSpaceId = fs.id
     inner join dbo.reporting_period as rp_first on f.firstReportingPeriodId = rp_first.id and fs.source = rp_first.type
-    inner join dbo.reporting_period as rp on fs.source = rp.type and rp.period = :period
+    -- One row per funding per month in the range, the income window below is only computed once for all months
+    inner join dbo.reporting_period as rp on fs.source = rp.type and rp.period between :start_period and :end_period
     left outer join dbo.reporting_period as rp_last on f.lastReportingPeriodId = rp_last.ID and fs.source = rp_last.type
     inner join dbo.enrollment
         as enrollment on enrollment.Id = f.enrollmentId and
@@ -93,9 +94,10 @@ select
         from dbo.income_determination
          where deletedDate is null) as family_det_temp
       on family_det_temp.familyId = family.Id and rn = 1
-where rp_first.period <= :period and (rp_last.period is null or rp_last.period >= :period)
+where rp_first.period <= rp.period and (rp_last.period is null or rp_last.period >= rp.period)
 AND f.deletedDate is NULL AND
     enrollment.deletedDate IS NULL and
     child.deletedDate is NULL and
     family.deletedDate is NULL
+order by rp.period
 
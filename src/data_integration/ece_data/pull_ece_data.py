@@ -1,9 +1,13 @@
 import os
+import json
 import sqlalchemy
 import pandas as pd
 import calendar
 from sqlalchemy.sql import text
 from datetime import datetime
+from build_pipeline.metrics import timed, add_rows_in
+from build_pipeline.writers import ChunkWriter, PARQUET
+from student_schema import apply_schema, concat_typed, get_memory_mb, report_memory
 
 # File paths
 DIR_NAME = os.path.dirname(os.path.realpath(__file__))
@@ -12,6 +16,17 @@ SPACE_SQL_FILE = DIR_NAME + '/space_pull.sql'
 START_DATE = '2020-07-01'
 END_DATE = '2021-03-01'
 
+# Months already closed rarely change, incremental pulls only go back this many months before the last pull
+LOOKBACK_MONTHS = 2
+WATERMARK_FILE = 'watermark.json'
+WATERMARK_KEY = 'watermark'
+START_MONTH_KEY = 'start_month'
+UPDATED_KEY = 'updated_at'
+PERIOD_COL = 'reporting_period'
+
+# Rows fetched from the server side cursor at a time, bounds memory however many months are pulled
+EXTRACT_CHUNK_ROWS = 20000
+
 
 def get_space_df(db_conn: sqlalchemy.engine) -> pd.DataFrame:
     """
@@ -20,24 +35,176 @@ def get_space_df(db_conn: sqlalchemy.engine) -> pd.DataFrame:
     :return: Dataframe of funding space table
     """
     df = pd.read_sql(sql=text(open(SPACE_SQL_FILE).read()), con=db_conn)
+    add_rows_in(df.shape[0])
     return df
 
 
-def backfill_ece(db_conn: sqlalchemy.engine, start_month: str = START_DATE, end_month: str = END_DATE) -> pd.DataFrame:
+@timed
+def backfill_ece(db_conn: sqlalchemy.engine, start_month: str = START_DATE, end_month: str = END_DATE,
+                 per_month: bool = False) -> pd.DataFrame:
     """
     Pulls data from ECE Reporter for all the months between start and end month (inclusive) using data
-    as of the data_active_date to adjust for data that was added in bulk after the relevant month
+    as of the data_active_date to adjust for data that was added in bulk after the relevant month.
+    By default the whole range is pulled in one query so the joins and income determination window
+    are only computed once
     :param db_conn: connection to ECE database
     :param start_month: First month to pull data from
     :param end_month: Last month to pull data from
-    the database as if the query were run on this day.
+    :param per_month: Run one query per month instead, for comparing against the single query
     :return: Combined dataframe of all the months worth of data in the range
     """
+    sql = text(open(CHILD_SQL_FILE).read())
+    if not per_month:
+        print(f"Pulling {start_month} to {end_month}")
+        parameters = {'start_period': start_month, 'end_period': end_month}
+        raw_df = pd.read_sql(sql=sql, params=parameters, con=db_conn)
+        add_rows_in(raw_df.shape[0])
+        final_df = apply_schema(raw_df)
+        report_memory('ECE student data', get_memory_mb(raw_df), get_memory_mb(final_df))
+        return final_df
+
     report_list = []
     for month in pd.date_range(start_month, end_month, freq='MS').tolist():
         print(f"Pulling {month}")
-        parameters = {'period': month}
-        month_child_df = pd.read_sql(sql=text(open(CHILD_SQL_FILE).read()), params=parameters, con=db_conn)
-        report_list.append(month_child_df)
-    final_df = pd.concat(report_list)
+        parameters = {'start_period': month, 'end_period': month}
+        month_child_df = pd.read_sql(sql=sql, params=parameters, con=db_conn)
+        add_rows_in(month_child_df.shape[0])
+        report_list.append(apply_schema(month_child_df))
+    final_df = concat_typed(report_list)
+    return final_df
+
+
+@timed
+def backfill_ece_chunks(db_conn: sqlalchemy.engine, start_month: str = START_DATE, end_month: str = END_DATE,
+                        chunksize: int = EXTRACT_CHUNK_ROWS):
+    """
+    Streams the same range query as backfill_ece in chunks of rows, typed as they're fetched. Use a connection
+    opened with stream_results so the driver fetches from a server side cursor instead of buffering the whole result
+    :param db_conn: connection to ECE database
+    :param start_month: First month to pull data from
+    :param end_month: Last month to pull data from
+    :param chunksize: number of rows per chunk
+    :return: generator of dataframes ordered by reporting period
+    """
+    print(f"Streaming {start_month} to {end_month}")
+    parameters = {'start_period': start_month, 'end_period': end_month}
+    raw_mb, typed_mb = 0, 0
+    for chunk_df in pd.read_sql(sql=text(open(CHILD_SQL_FILE).read()), params=parameters, con=db_conn,
+                                chunksize=chunksize):
+        add_rows_in(chunk_df.shape[0])
+        typed_df = apply_schema(chunk_df)
+        raw_mb += get_memory_mb(chunk_df)
+        typed_mb += get_memory_mb(typed_df)
+        yield typed_df
+    report_memory('ECE student data', raw_mb, typed_mb)
+
+
+def get_partition_file(partition_folder: str, month: pd.Timestamp) -> str:
+    return f"{partition_folder}/period={month.strftime('%Y-%m-%d')}.parquet"
+
+
+def read_watermark(partition_folder: str) -> dict:
+    """
+    Reads the record of the last incremental pull
+    :param partition_folder: folder with monthly partitions
+    :return: dictionary with the last month pulled and the start of the range, empty if there is none
+    """
+    watermark_file = f'{partition_folder}/{WATERMARK_FILE}'
+    if not os.path.exists(watermark_file):
+        return {}
+    with open(watermark_file) as f:
+        return json.load(f)
+
+
+def write_watermark(partition_folder: str, start_month: pd.Timestamp, end_month: pd.Timestamp) -> None:
+    watermark_file = f'{partition_folder}/{WATERMARK_FILE}'
+    with open(watermark_file + '.tmp', 'w') as f:
+        json.dump({WATERMARK_KEY: end_month.strftime('%Y-%m-%d'),
+                   START_MONTH_KEY: start_month.strftime('%Y-%m-%d'),
+                   UPDATED_KEY: datetime.now().isoformat(timespec='seconds')}, f, indent=2)
+    os.replace(watermark_file + '.tmp', watermark_file)
+
+
+def get_incremental_start(partition_folder: str, months: pd.DatetimeIndex, lookback_months: int) -> pd.Timestamp:
+    """
+    Finds the first month that has to be pulled again: the watermark minus the look back window, or
+    earlier if a month in the range was never stored
+    :param partition_folder: folder with monthly partitions
+    :param months: every month in the requested range
+    :param lookback_months: number of months before the watermark to pull again
+    :return: first month to pull
+    """
+    watermark = read_watermark(partition_folder)
+    if not watermark or pd.Timestamp(watermark[START_MONTH_KEY]) != months[0]:
+        return months[0]
+
+    pull_start = pd.Timestamp(watermark[WATERMARK_KEY]) - pd.DateOffset(months=lookback_months)
+    missing = [x for x in months if x < pull_start and not os.path.exists(get_partition_file(partition_folder, x))]
+    return min(missing + [max(pull_start, months[0])])
+
+
+@timed
+def incremental_backfill_ece_chunks(db_conn: sqlalchemy.engine, partition_folder: str, start_month: str = START_DATE,
+                                    end_month: str = END_DATE, lookback_months: int = LOOKBACK_MONTHS,
+                                    full_refresh: bool = False, chunksize: int = EXTRACT_CHUNK_ROWS):
+    """
+    Streams ECE Reporter data for the range, one stored month or pulled chunk at a time. Each month it extracts
+    is kept as a Parquet partition. Later runs only query the months after the last pull plus a look back window
+    and read the rest from disk. Partitions and the watermark are only replaced once every chunk has been consumed
+    :param db_conn: connection to ECE database, opened with stream_results to keep memory flat
+    :param partition_folder: folder to keep monthly partitions in, these contain PII
+    :param start_month: First month to pull data from
+    :param end_month: Last month to pull data from
+    :param lookback_months: Number of months before the last pull to query again to pick up late edits
+    :param full_refresh: Ignore stored months and pull the whole range
+    :param chunksize: number of rows per pulled chunk
+    :return: generator of dataframes
+    """
+    os.makedirs(partition_folder, exist_ok=True)
+    months = pd.date_range(start_month, end_month, freq='MS')
+    pull_start = months[0] if full_refresh else get_incremental_start(partition_folder, months, lookback_months)
+    print(f"Reading {sum(months < pull_start)} stored months, pulling {sum(months >= pull_start)} months")
+
+    for month in months[months < pull_start]:
+        yield apply_schema(pd.read_parquet(get_partition_file(partition_folder, month)))
+
+    # Rows come back ordered by period, so each month's writer can be finished as soon as the next month starts
+    writers = []
+    empty_df = None
+    for chunk_df in backfill_ece_chunks(db_conn, start_month=pull_start.strftime('%Y-%m-%d'), end_month=end_month,
+                                        chunksize=chunksize):
+        empty_df = chunk_df.head(0)
+        periods = chunk_df[PERIOD_COL]
+        for month in pd.DatetimeIndex(periods.unique()):
+            if not writers or writers[-1][0] != month:
+                writers.append((month, ChunkWriter(get_partition_file(partition_folder, month), PARQUET)))
+            writers[-1][1].write(chunk_df[periods == month])
+        yield chunk_df
+
+    # Write every pulled month, including empty ones, so the partitions cover the whole range
+    written = {month: writer for month, writer in writers}
+    for month in months[months >= pull_start]:
+        writer = written.get(month, ChunkWriter(get_partition_file(partition_folder, month), PARQUET))
+        writer.close(empty_frame=empty_df)
+    write_watermark(partition_folder, start_month=months[0], end_month=months[-1])
+
+
+@timed
+def incremental_backfill_ece(db_conn: sqlalchemy.engine, partition_folder: str, start_month: str = START_DATE,
+                             end_month: str = END_DATE, lookback_months: int = LOOKBACK_MONTHS,
+                             full_refresh: bool = False) -> pd.DataFrame:
+    """
+    Pulls ECE Reporter data like incremental_backfill_ece_chunks but returns it as one dataframe
+    :param db_conn: connection to ECE database
+    :param partition_folder: folder to keep monthly partitions in, these contain PII
+    :param start_month: First month to pull data from
+    :param end_month: Last month to pull data from
+    :param lookback_months: Number of months before the last pull to query again to pick up late edits
+    :param full_refresh: Ignore stored months and pull the whole range
+    :return: Combined dataframe of all the months worth of data in the range
+    """
+    chunk_list = list(incremental_backfill_ece_chunks(db_conn, partition_folder, start_month=start_month,
+                                                      end_month=end_month, lookback_months=lookback_months,
+                                                      full_refresh=full_refresh))
+    final_df = concat_typed(chunk_list)
     return final_df
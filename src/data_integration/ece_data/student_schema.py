@@ -0,0 +1,99 @@
+import os
+import re
+import pandas as pd
+from pandas.api.types import union_categoricals
+
+DIR_NAME = os.path.dirname(os.path.realpath(__file__))
+STUDENT_TABLE_FILE = DIR_NAME + '/../../analytics_tables/ece_students.sql'
+
+# Postgres types from the analytics table and the pandas dtype each is held as
+CATEGORY = 'category'
+STRING = 'string'
+DATETIME = 'datetime64[ns]'
+TYPE_MAPPING = {'varchar': CATEGORY, 'text': CATEGORY, 'int': 'Int32', 'boolean': 'boolean',
+                'date': DATETIME, 'double precision': 'float64'}
+
+# Text columns with close to one value per row gain nothing from being categorical
+HIGH_CARDINALITY_COLUMNS = ['source_child_id']
+
+COLUMN_PATTERN = re.compile(r'^\s*(\w+)\s+([a-z ]+?)\s*(\(\d+\))?\s*,?\s*$')
+
+
+def read_table_columns(table_file: str = STUDENT_TABLE_FILE) -> dict:
+    """
+    Reads column names and types from a create table statement, ignoring the length of varchar columns
+    :param table_file: path to SQL file with one column definition per line
+    :return: ordered dictionary of column name to Postgres type
+    """
+    column_types = {}
+    with open(table_file) as f:
+        for line in f:
+            match = COLUMN_PATTERN.match(line)
+            if match:
+                column_types[match.group(1)] = match.group(2)
+    return column_types
+
+
+def get_student_dtypes(table_file: str = STUDENT_TABLE_FILE) -> dict:
+    """
+    Builds the pandas dtypes for ECE student data from the analytics table definition
+    :param table_file: path to the create table statement for the student table
+    :return: dictionary of column name to pandas dtype
+    """
+    dtypes = {}
+    for col, column_type in read_table_columns(table_file).items():
+        if column_type not in TYPE_MAPPING:
+            raise Exception(f"No pandas type for {col} of type {column_type} in {table_file}")
+        dtypes[col] = STRING if col in HIGH_CARDINALITY_COLUMNS else TYPE_MAPPING[column_type]
+    return dtypes
+
+
+STUDENT_DTYPES = get_student_dtypes()
+
+
+def get_memory_mb(df: pd.DataFrame) -> float:
+    return df.memory_usage(deep=True).sum() / 1024 ** 2
+
+
+def apply_schema(df: pd.DataFrame, dtypes: dict = STUDENT_DTYPES) -> pd.DataFrame:
+    """
+    Converts the columns of a pulled dataframe to compact types. The database driver returns flags as 0/1
+    and dates as objects, so those are parsed before casting. Columns not in dtypes are left as they are
+    :param df: dataframe as read from the database
+    :param dtypes: dictionary of column name to pandas dtype
+    :return: dataframe with typed columns
+    """
+    df = df.copy()
+    for col, dtype in dtypes.items():
+        if col not in df.columns or df[col].dtype == dtype:
+            continue
+        if dtype == DATETIME:
+            df[col] = pd.to_datetime(df[col])
+        elif dtype == 'boolean' and df[col].dtype == object:
+            df[col] = df[col].map({True: True, False: False, 1: True, 0: False}).astype(dtype)
+        else:
+            df[col] = df[col].astype(dtype)
+    return df
+
+
+def report_memory(name: str, before_mb: float, after_mb: float) -> None:
+    ratio = before_mb / after_mb if after_mb else 0
+    print(f"{name} memory: {before_mb:.1f} MB as read, {after_mb:.1f} MB typed ({ratio:.1f}x smaller)")
+
+
+def concat_typed(df_list: [pd.DataFrame]) -> pd.DataFrame:
+    """
+    Concatenates typed dataframes. Categoricals from different pulls have different categories, which
+    pd.concat would turn back into objects, so each is first given the union of all the categories
+    :param df_list: list of dataframes with the same columns
+    :return: combined dataframe with categorical columns kept
+    """
+    if not df_list:
+        return pd.DataFrame(columns=list(STUDENT_DTYPES)).astype(STUDENT_DTYPES)
+    category_cols = [col for col in df_list[0].columns
+                     if all(col in x.columns and pd.api.types.is_categorical_dtype(x[col]) for x in df_list)]
+    if category_cols:
+        categories = {col: union_categoricals([x[col] for x in df_list], ignore_order=True).categories
+                      for col in category_cols}
+        df_list = [x.astype({col: pd.CategoricalDtype(categories[col]) for col in category_cols}) for x in df_list]
+    return pd.concat(df_list)
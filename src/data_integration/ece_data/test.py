@@ -12,7 +12,7 @@ class TestMatchingData(unittest.TestCase):
     @classmethod    
     def setUpClass(cls):
         db_conn = get_mysql_connection(section='ECE Reporter DB')
-        parameters = {'period': MONTH, 'active_data_date': DATA_ACTIVE_DATE}
+        parameters = {'start_period': MONTH, 'end_period': MONTH, 'active_data_date': DATA_ACTIVE_DATE}
         cls.month_child_df = pd.read_sql(sql=text(open(CHILD_SQL_FILE).read()),
                                          params=parameters,
                                          con=db_conn)
@@ -222,7 +222,7 @@ def parse_post_18_report(filename, month, year):
     return df      
 
 
-def get_historical_c4k(final_filename):
+def get_historical_c4k(final_filename=None):
     
     # If it's the first file we process, just use that as the base DF
     is_first = True
@@ -258,7 +258,9 @@ def get_historical_c4k(final_filename):
     df.replace('-', 0, inplace=True)
     df.fillna(0, inplace=True)
     
-    df.to_csv(final_filename, index=False)
+    if final_filename:
+        df.to_csv(final_filename, index=False)
+    return df
 
 
 
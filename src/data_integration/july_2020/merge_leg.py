@@ -3,13 +3,13 @@ import pandas as pd
 from build_legislative_lookup import SITE_LEGIS_LOOKUP, parse_legislator_results
 
 
-def merge_legislative_data(student_df, write_file):
+def merge_legislative_data(student_df, write_file=None):
     """
     Combines legislative data associated with a site with student data to build a table that can show
     legislators associated with children attending sites in their districts
     :param student_df:
-    :param write_file:
-    :return: None, saves file to disk
+    :param write_file: Saves the merged data to this file if a name is provided
+    :return: merged dataframe
     """
 
     with open(SITE_LEGIS_LOOKUP, 'r') as f:
@@ -32,5 +32,6 @@ def merge_legislative_data(student_df, write_file):
     # Build table with
 
     merged_df = student_df.merge(leg_df, how='left', on='Facility Code')
-    merged_df.to_csv(write_file, index=False)
-
+    if write_file:
+        merged_df.to_csv(write_file, index=False)
+    return merged_df
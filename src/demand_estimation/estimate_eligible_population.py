@@ -1,5 +1,6 @@
 import pandas as pd
 import censusdata
+from census_cache import cached_download, cached_censusvar
 
 
 '''
@@ -19,8 +20,8 @@ PROPORTION_OF_LAST_BUCKET = .44
 def get_household_size_buckets():
 
     household_size_fields = [f"{HOUSEHOLD_SIZE_FIELD}_{str(x).zfill(3)}E" for x in range(3, 9)]
-    household_size_pull = censusdata.download('acs5', 2019, censusdata.censusgeo([('state', STATE_CODE)]), household_size_fields)
-    field_dicts = censusdata.censusvar('acs5', 2019, household_size_fields)
+    household_size_pull = cached_download('acs5', 2019, censusdata.censusgeo([('state', STATE_CODE)]), household_size_fields)
+    field_dicts = cached_censusvar('acs5', 2019, household_size_fields)
     rename_dict = {x: field_dicts[x][1].split('!!')[-1][0] for x in household_size_fields}
 
     household_size_pull.rename(columns=rename_dict, inplace=True)
@@ -33,9 +34,9 @@ def get_under_6_full_poverty_levels():
     # 3 and 15 here are the upper and lower bounds for the range of fields from the census for relative income to poverty
     # for under 6 year olds. This does not include the aggregate and goes from Under .5 of Poverty to 5x poverty and above
     under_6_fields = [f'{POVERTY_PROPORTION_FIELD}_{str(x).zfill(3)}E' for x in range(3, 15)]
-    under_6_initial_pull_state = censusdata.download('acs5', 2019, censusdata.censusgeo([('state', STATE_CODE)]), under_6_fields)
-    under_6_initial_pull_towns = censusdata.download('acs5', 2019, censusdata.censusgeo([('state', STATE_CODE), ('county', '*'), ('county subdivision', '*')]), under_6_fields)
-    field_dicts = censusdata.censusvar('acs5', 2019, under_6_fields)
+    under_6_initial_pull_state = cached_download('acs5', 2019, censusdata.censusgeo([('state', STATE_CODE)]), under_6_fields)
+    under_6_initial_pull_towns = cached_download('acs5', 2019, censusdata.censusgeo([('state', STATE_CODE), ('county', '*'), ('county subdivision', '*')]), under_6_fields)
+    field_dicts = cached_censusvar('acs5', 2019, under_6_fields)
     rename_dict = {x: field_dicts[x][1].split('!!')[-1] for x in under_6_fields}
     under_6_initial_pull_state.rename(columns=rename_dict, inplace=True)
     under_6_initial_pull_towns.rename(columns=rename_dict, inplace=True)
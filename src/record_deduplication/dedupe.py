@@ -2,6 +2,7 @@ from recordlinkage import Index, Compare
 import pandas as pd
 from builtins import isinstance
 import sys
+from build_pipeline.metrics import timed, add_rows_in
 
 '''
 To reference more information about deduplication with recordlinkage,
@@ -15,6 +16,9 @@ CHILD_ID = 'child_id'
 DEDUPLICATED_ID = 'deduplicated_id'
 IS_DUPE_COL = 'is_duplicate'
 
+# Rows fetched from the database at a time
+DB_CHUNK_ROWS = 20000
+
 SQL_QUERY = """
             select c.id as child_id,
             birthdate,
@@ -37,11 +41,19 @@ def get_dedupe_mapping_from_db(db_conn, threshold=SCORE_THRESHOLD) -> pd.DataFra
     :param threshold: Cutoff for deduplication pairs
     :return: dataframe
     """
-    raw_df = pd.read_sql(sql=SQL_QUERY, con=db_conn)
+    # Record linkage compares every pair so the whole table is needed, fetching in chunks avoids also
+    # holding the driver's copy of the full result
+    chunk_list = []
+    for chunk_df in pd.read_sql(sql=SQL_QUERY, con=db_conn, chunksize=DB_CHUNK_ROWS):
+        add_rows_in(chunk_df.shape[0])
+        chunk_list.append(chunk_df)
+    # Chunks each number their rows from zero, record linkage needs one unique index across all of them
+    raw_df = pd.concat(chunk_list, ignore_index=True)
     return_df = identify_duplicates(df=raw_df, threshold=threshold)
     return return_df
 
 
+@timed
 def identify_duplicates(df, threshold, show_ranks_distribution=True, filename=None):
     '''
     Identifies duplicates in a given data frame that consists of
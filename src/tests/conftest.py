@@ -0,0 +1,10 @@
+import os
+import sys
+
+SRC_DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+CENSUS_DIR = os.path.join(SRC_DIR, 'data_integration', 'census_data')
+
+# Modules import each other from src, census_data modules import their siblings directly
+for path in [SRC_DIR, CENSUS_DIR]:
+    if path not in sys.path:
+        sys.path.insert(0, path)
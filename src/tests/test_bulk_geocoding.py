@@ -0,0 +1,159 @@
+import time
+import threading
+import concurrent.futures as futures
+from types import SimpleNamespace
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pytest
+import bulk_geocoding
+from build_pipeline.metrics import track, CHILDREN_KEY, NAME_KEY
+
+# Census responses have no header, one row per address in LOCATION_FIELDS order
+RESPONSE_CSV = ('"A12","1 Main St, Hartford, CT, 06106","Match","Exact","1 MAIN ST, HARTFORD, CT, 06106",'
+                '"-72.68,41.76","123","L"\n'
+                '"7","2 Elm St, Hartford, CT, 06106","No_Match"\n')
+TRUNCATED = 'truncated'
+
+
+class StandInGeocoder(BaseHTTPRequestHandler):
+    """
+    Plays back a list of responses, one per request. Each is a status code, a status code with headers, a number of
+    seconds to wait before answering so the client times out, or TRUNCATED to close the connection part way
+    through the body
+    """
+    responses = []
+    requests = 0
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        StandInGeocoder.requests += 1
+        response = StandInGeocoder.responses.pop(0) if StandInGeocoder.responses else 200
+        headers = {}
+        if isinstance(response, float):
+            time.sleep(response)
+            response = 200
+        elif isinstance(response, tuple):
+            response, headers = response
+        body = RESPONSE_CSV.encode() if response in [200, TRUNCATED] else b'unavailable'
+        try:
+            self.send_response(200 if response == TRUNCATED else response)
+            for name, value in headers.items():
+                self.send_header(name, value)
+            if response == TRUNCATED:
+                # Announce a chunk of the whole body, then hang up after half of it
+                self.send_header('Transfer-Encoding', 'chunked')
+                self.end_headers()
+                self.wfile.write(f'{len(body):x}\r\n'.encode() + body[:len(body) // 2])
+                return
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def geocoder_url(monkeypatch):
+    # Waits are recorded instead of slept, the stand in server still sleeps for real
+    waits = []
+    monkeypatch.setattr(bulk_geocoding, 'time', SimpleNamespace(sleep=waits.append))
+    monkeypatch.setattr(bulk_geocoding, 'BACKOFF_SECONDS', 1)
+    monkeypatch.setattr(bulk_geocoding, 'REQUEST_TIMEOUT_SECONDS', 0.2)
+    StandInGeocoder.responses = []
+    StandInGeocoder.requests = 0
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StandInGeocoder)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f'http://127.0.0.1:{server.server_address[1]}/addressbatch', waits
+    server.shutdown()
+    server.server_close()
+
+
+def upload(url):
+    return bulk_geocoding.get_bulk_data_upload_from_census(b'A12,1 Main St,Hartford,CT,06106\n', 'batch.csv', url)
+
+
+def test_retries_server_errors_with_backoff(geocoder_url):
+    url, waits = geocoder_url
+    StandInGeocoder.responses = [503, 502]
+
+    output_df = upload(url)
+
+    assert StandInGeocoder.requests == 3
+    assert waits == [1, 2]
+    # Child IDs stay text, whether or not they look like numbers
+    assert output_df[bulk_geocoding.CHILD_ID].tolist() == ['A12', '7']
+    assert output_df[bulk_geocoding.MATCH_IDENTIFIER].tolist() == ['Match', 'No_Match']
+
+
+def test_retries_timeouts(geocoder_url):
+    url, waits = geocoder_url
+    StandInGeocoder.responses = [1.0]
+
+    output_df = upload(url)
+
+    assert StandInGeocoder.requests == 2
+    assert waits == [1]
+    assert output_df.shape[0] == 2
+
+
+def test_rate_limits_wait_as_long_as_asked(geocoder_url):
+    url, waits = geocoder_url
+    StandInGeocoder.responses = [(429, {'Retry-After': '7'}), 429]
+
+    output_df = upload(url)
+
+    # Without a Retry-After header the usual backoff applies
+    assert StandInGeocoder.requests == 3
+    assert waits == [7, 2]
+    assert output_df.shape[0] == 2
+
+
+def test_retries_truncated_responses(geocoder_url):
+    url, waits = geocoder_url
+    StandInGeocoder.responses = [TRUNCATED]
+
+    output_df = upload(url)
+
+    assert StandInGeocoder.requests == 2
+    assert waits == [1]
+    assert output_df.shape[0] == 2
+
+
+def test_gives_up_after_max_retries(geocoder_url, monkeypatch):
+    url, waits = geocoder_url
+    monkeypatch.setattr(bulk_geocoding, 'MAX_RETRIES', 2)
+    StandInGeocoder.responses = [500, 500, 500]
+
+    with pytest.raises(Exception, match='failed after 3 attempts'):
+        upload(url)
+    assert waits == [1, 2]
+
+
+def test_client_errors_are_not_retried(geocoder_url):
+    url, waits = geocoder_url
+    StandInGeocoder.responses = [400]
+
+    with pytest.raises(Exception):
+        upload(url)
+    assert StandInGeocoder.requests == 1
+    assert waits == []
+
+
+def test_uploads_on_worker_threads_are_timed(geocoder_url):
+    url, _ = geocoder_url
+    geocode_batch = bulk_geocoding.get_batch_geocoder(bulk_geocoding.CENSUS_BACKEND, url)
+    batch_df = bulk_geocoding.pd.DataFrame({bulk_geocoding.CHILD_ID: ['A12'], bulk_geocoding.ADDRESS_COL: ['1 Main St'],
+                                            bulk_geocoding.TOWN_COL: ['Hartford'], bulk_geocoding.STATE_COL: ['CT'],
+                                            bulk_geocoding.ZIP_CODE_COL: ['06106']})
+
+    with track('ece_geocode') as record:
+        with futures.ThreadPoolExecutor(max_workers=2) as executor:
+            bound = bulk_geocoding.bind_record(geocode_batch)
+            future_list = [executor.submit(bound, batch_df, f'batch_{i}.csv') for i in range(2)]
+            for future in future_list:
+                future.result()
+
+    assert [x[NAME_KEY] for x in record[CHILDREN_KEY]] == ['get_bulk_data_upload_from_census'] * 2
@@ -0,0 +1,66 @@
+import os
+import pytest
+import pandas as pd
+from data_integration.connections.bulk_load import append_chunks, prepare_chunk
+from data_integration.ece_data.student_schema import read_table_columns
+from bulk_geocoding import get_geo_id_column, CHILD_ID
+from shapefiles import TOWN, SENATE, HOUSE, BLOCK
+
+GEOCODE_TABLE_FILE = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))),
+                                  'analytics_tables', 'ece_geography.sql')
+
+
+class StandInConnection:
+    """
+    Answers the column lookup with the columns of a create table statement and records COPY statements
+    """
+    def __init__(self, column_types):
+        self.column_types = column_types
+        self.copies = []
+        self.connection = self
+
+    def begin(self):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def execute(self, sql, **params):
+        return self
+
+    def fetchall(self):
+        return list(self.column_types.items())
+
+    def cursor(self):
+        return self
+
+    def copy_expert(self, sql, buffer):
+        self.copies.append((sql, buffer.read()))
+
+    def close(self):
+        pass
+
+
+def geocode_output():
+    columns = [get_geo_id_column(x) for x in [TOWN, SENATE, HOUSE, BLOCK]] + [CHILD_ID]
+    return pd.DataFrame([['0900337070', '09003000001', '09003000001', '090034003001', 'A12']], columns=columns)
+
+
+def test_geocode_output_loads_into_geocode_table():
+    conn = StandInConnection(read_table_columns(GEOCODE_TABLE_FILE))
+
+    assert append_chunks(geocode_output(), 'ece_student_data_geocode', conn) == 1
+    sql, rows = conn.copies[0]
+    assert '("county_subdivision_geoid", "sldu_geoid", "sldl_geoid", "block_geoid", "child_id")' in sql
+    assert rows == '0900337070,09003000001,09003000001,090034003001,A12\n'
+
+
+def test_columns_missing_from_table_fail_the_load():
+    column_types = read_table_columns(GEOCODE_TABLE_FILE)
+    chunk = geocode_output().rename(columns={'block_geoid': 'block_geo_id'})
+
+    with pytest.raises(Exception, match='block_geo_id are not in table'):
+        prepare_chunk(chunk, column_types, table_name='uploaded_data.ece_student_data_geocode')
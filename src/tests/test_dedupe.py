@@ -0,0 +1,22 @@
+import pandas as pd
+from record_deduplication import dedupe
+
+COLUMNS = ['child_id', 'birthdate', 'sasid', 'uniqueId', 'firstName', 'middleName', 'lastName']
+
+
+def test_duplicates_across_chunks(monkeypatch):
+    # Each chunk is numbered from zero, like read_sql with a chunksize
+    chunks = [pd.DataFrame([['a', '2017-01-05', '111', None, 'ana', 'm', 'lopez'],
+                            ['b', '2016-03-02', '222', None, 'ben', None, 'smith']], columns=COLUMNS),
+              pd.DataFrame([['c', '2018-07-09', '333', None, 'cy', None, 'jones'],
+                            ['d', '2017-01-05', '111', None, 'ana', 'm', 'lopez']], columns=COLUMNS)]
+    monkeypatch.setattr(dedupe.pd, 'read_sql', lambda sql, con, chunksize: iter(chunks))
+
+    out = dedupe.get_dedupe_mapping_from_db(db_conn=None).set_index(dedupe.CHILD_ID)
+
+    assert list(out.index) == ['a', 'b', 'c', 'd']
+    # Only the pair split across chunks is linked, whichever of the two is kept as the original
+    assert out.loc[['b', 'c'], dedupe.IS_DUPE_COL].tolist() == [False, False]
+    assert out.loc[['a', 'd'], dedupe.IS_DUPE_COL].sum() == 1
+    assert out.loc['d', dedupe.DEDUPLICATED_ID] == out.loc['a', dedupe.DEDUPLICATED_ID]
+    assert out[dedupe.DEDUPLICATED_ID].nunique() == 3
@@ -0,0 +1,30 @@
+import pandas as pd
+from geocode_cache import GeocodeCache, RESULT_FIELDS, ADDRESS_KEY
+
+
+def results(rows):
+    return pd.DataFrame(rows, columns=[ADDRESS_KEY] + RESULT_FIELDS).set_index(ADDRESS_KEY)
+
+
+def test_unmatched_addresses_are_not_cached(tmp_path):
+    cache = GeocodeCache(str(tmp_path / 'geocode_cache.sqlite'))
+    cache.store(results([['1 main st|hartford|ct|06106', 'Match', 'Exact', '1 MAIN ST', '-72.68,41.76', '123', 'L'],
+                         ['2 elm st|hartford|ct|06106', 'No_Match', None, None, None, None, None],
+                         ['3 oak st|hartford|ct|06106', 'Tie', None, None, None, None, None]]))
+
+    found = cache.lookup(pd.Series(['1 main st|hartford|ct|06106', '2 elm st|hartford|ct|06106',
+                                    '3 oak st|hartford|ct|06106']))
+    cache.close()
+
+    assert found.index.tolist() == ['1 main st|hartford|ct|06106']
+
+
+def test_earlier_unmatched_entries_are_retried(tmp_path):
+    # Caches written before unmatched results were skipped can still hold them
+    cache = GeocodeCache(str(tmp_path / 'geocode_cache.sqlite'))
+    cache.conn.execute(f"insert into geocode ({ADDRESS_KEY}, range_match_indicator) values ('2 elm st', 'No_Match')")
+
+    found = cache.lookup(pd.Series(['2 elm st']))
+    cache.close()
+
+    assert found.empty
@@ -0,0 +1,24 @@
+import concurrent.futures as futures
+from build_pipeline.metrics import track, timed, bind_record, CHILDREN_KEY, NAME_KEY
+
+
+@timed
+def hot_function():
+    return None
+
+
+def test_worker_threads_report_to_the_submitting_record():
+    with track('stage') as record:
+        with futures.ThreadPoolExecutor(max_workers=2) as executor:
+            for future in [executor.submit(bind_record(hot_function)) for _ in range(3)]:
+                future.result()
+
+    assert [x[NAME_KEY] for x in record[CHILDREN_KEY]] == ['hot_function'] * 3
+
+
+def test_unbound_worker_threads_are_not_attached():
+    with track('stage') as record:
+        with futures.ThreadPoolExecutor(max_workers=1) as executor:
+            executor.submit(hot_function).result()
+
+    assert record[CHILDREN_KEY] == []
@@ -0,0 +1,28 @@
+import math
+import geopandas as gpd
+from shapely.geometry import Polygon
+from setup_geo_json import simplify_polygons
+from shapefiles import CT_EPSG_CODE
+
+# Two towns 10 km across sharing a border with a 20 m wiggle every 100 m, in meters of the Connecticut projection
+BORDER = [(5000 + 20 * math.sin(y / 30), y) for y in range(0, 10001, 100)]
+
+
+def neighboring_towns():
+    west = Polygon([(0, 0)] + BORDER + [(0, 10000)])
+    east = Polygon([(10000, 0)] + BORDER + [(10000, 10000)])
+    return gpd.GeoSeries([west, east], index=['west', 'east'], crs=f'EPSG:{CT_EPSG_CODE}')
+
+
+def test_neighbors_share_their_simplified_border():
+    towns = neighboring_towns()
+
+    simplified = simplify_polygons(towns, tolerance=50)
+
+    assert list(simplified.index) == ['west', 'east']
+    assert all(simplified.geom_type == 'Polygon')
+    # The wiggle is smaller than the tolerance so the border is simplified, the same way for both towns
+    assert simplified.apply(lambda x: len(x.exterior.coords)).sum() < towns.apply(lambda x: len(x.exterior.coords)).sum()
+    assert simplified['west'].intersection(simplified['east']).area < 1
+    assert abs(simplified['west'].union(simplified['east']).area - towns.unary_union.area) < 1
+
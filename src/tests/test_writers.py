@@ -0,0 +1,37 @@
+import os
+import pytest
+import pandas as pd
+from build_pipeline.writers import write_chunks, write_frame, CSV, PARQUET
+
+
+def failing_chunks():
+    yield pd.DataFrame({'child_id': ['A12'], 'town': ['Hartford']})
+    raise ValueError('lost the database connection')
+
+
+@pytest.mark.parametrize('output_format', [CSV, PARQUET])
+def test_failed_chunks_leave_no_partial_file(tmp_path, output_format):
+    file_name = str(tmp_path / f'ece_student_data.{output_format}')
+
+    with pytest.raises(ValueError):
+        write_frame(failing_chunks(), file_name, output_format=output_format)
+
+    assert os.listdir(tmp_path) == []
+
+
+def test_closing_early_leaves_no_partial_file(tmp_path):
+    file_name = str(tmp_path / 'ece_student_data.parquet')
+    chunks = write_chunks(failing_chunks(), file_name, output_format=PARQUET)
+
+    next(chunks)
+    chunks.close()
+
+    assert os.listdir(tmp_path) == []
+
+
+def test_finished_chunks_are_moved_into_place(tmp_path):
+    file_name = str(tmp_path / 'ece_student_data.parquet')
+
+    assert write_frame(pd.DataFrame({'child_id': ['A12', '7']}), file_name, output_format=PARQUET) == 2
+
+    assert os.listdir(tmp_path) == ['ece_student_data.parquet']